@@ -0,0 +1,129 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Benchmark cases. Every case runs in a fresh process with the qu_config
+# of the benchmark library on the PYTHONPATH and prints its result as
+# JSON, see run.py.
+
+import json
+import os
+import random
+import sys
+import time
+
+
+def latency(func, count):
+  """
+  Calls *func* *count* times and returns statistics of the durations.
+  """
+
+  times = []
+  for _ in range(count):
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+  times.sort()
+  return {
+    'requests': count,
+    'mean': sum(times) / count,
+    'p50': times[count // 2],
+    'p95': times[int(count * 0.95)],
+    'max': times[-1],
+  }
+
+
+def track_ids(count, seed=0, with_cover=False):
+  from qu.database import Session, Track
+  with Session() as session:
+    query = session.query(Track.id)
+    if with_cover:
+      query = query.filter(Track.cover_hash != None)
+    ids = [x.id for x in query]
+  rng = random.Random(seed)
+  return [rng.choice(ids) for _ in range(count)]
+
+
+def case_syncdb(full='0', jobs='1'):
+  from qu.database import syncdb
+  start = time.perf_counter()
+  with open(os.devnull, 'w') as devnull:
+    report = syncdb(jobs=int(jobs), full=full == '1', progress=devnull)
+  return {'seconds': time.perf_counter() - start, 'report': report.to_dict()}
+
+
+def case_home(count='200'):
+  from qu.web import create_app
+  client = create_app().test_client()
+  def get(url):
+    response = client.get(url)
+    assert response.status_code == 200, response.status_code
+    response.close()
+  return {
+    'home': latency(lambda: get('/'), int(count)),
+    'first_page': latency(lambda: get('/api/tracks?limit=100'), int(count)),
+  }
+
+
+def case_pic(count='500'):
+  from qu.web import create_app
+  client = create_app().test_client()
+  ids = iter(track_ids(int(count), with_cover=True))
+  def get():
+    response = client.get('/pic/{}'.format(next(ids)), follow_redirects=True)
+    response.get_data()
+    response.close()
+  return latency(get, int(count))
+
+
+def case_stream(count='50'):
+  from qu.web import create_app
+  client = create_app().test_client()
+  ids = track_ids(int(count))
+  total = 0
+  start = time.perf_counter()
+  for id in ids:
+    response = client.get('/stream/{}'.format(id))
+    total += len(response.get_data())
+    response.close()
+  seconds = time.perf_counter() - start
+  ranges = iter(ids * 4)
+  def get_range():
+    response = client.get('/stream/{}'.format(next(ranges)),
+      headers={'Range': 'bytes=1000-65535'})
+    response.get_data()
+    response.close()
+  return {
+    'streams': len(ids),
+    'bytes': total,
+    'seconds': seconds,
+    'megabytes_per_second': total / seconds / 1e6,
+    'range_requests': latency(get_range, len(ids) * 4),
+  }
+
+
+def main():
+  case, args = sys.argv[1], sys.argv[2:]
+  result = globals()['case_' + case](*args)
+  json.dump(result, sys.stdout)
+
+
+if __name__ == '__main__':
+  main()
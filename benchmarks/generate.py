@@ -0,0 +1,121 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from mutagen.id3 import ID3, APIC, TALB, TCON, TDRC, TIT2, TPE1, TPE2, TRCK
+import argparse
+import os
+import random
+
+# A silent MPEG-1 Layer III frame at 128 kbit/s and 44.1 kHz.
+FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413
+FRAMES_PER_SECOND = 44100 / 1152
+
+GENRES = ['Rock', 'Pop', 'Jazz', 'Electronic', 'Hip-Hop', 'Classical',
+  'Metal', 'Folk', 'Blues', 'Soundtrack']
+WORDS = ['night', 'river', 'light', 'dream', 'fire', 'blue', 'road',
+  'heart', 'shadow', 'summer', 'glass', 'echo', 'storm', 'gold', 'city']
+
+
+def make_cover(rng, size):
+  """
+  Returns *size* bytes of random data with a JPEG header. The data is
+  not a valid image, which is fine for everything but thumbnails.
+  """
+
+  size = max(size - 4, 0)
+  return b'\xff\xd8\xff\xe0' + rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def make_title(rng):
+  return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+
+
+def iter_tracks(count, tracks_per_album=10, albums_per_artist=5):
+  """
+  Yields tuples of the artist, album and track number of *count* tracks.
+  """
+
+  for index in range(count):
+    album = index // tracks_per_album
+    yield album // albums_per_artist, album, index % tracks_per_album + 1
+
+
+def generate(root, count, cover_size=64 * 1024, duration=2.0, seed=0):
+  """
+  Writes *count* MP3 files of *duration* seconds with ID3 tags into the
+  directory *root*, organized as `Artist/Album/NN Title.mp3`. All tracks
+  of an album embed the same cover of *cover_size* bytes (none if 0).
+  Returns the list of filenames.
+  """
+
+  rng = random.Random(seed)
+  audio = FRAME * max(int(duration * FRAMES_PER_SECOND), 1)
+  filenames = []
+  cover = None
+  last_album = None
+
+  for artist, album, number in iter_tracks(count):
+    if album != last_album:
+      last_album = album
+      genre = rng.choice(GENRES)
+      year = str(rng.randint(1960, 2016))
+      album_title = make_title(rng)
+      cover = make_cover(rng, cover_size) if cover_size else None
+
+    title = make_title(rng)
+    dirname = os.path.join(root, 'Artist {:05d}'.format(artist),
+      'Album {:06d}'.format(album))
+    os.makedirs(dirname, exist_ok=True)
+    filename = os.path.join(dirname, '{:02d} {}.mp3'.format(number, title))
+    with open(filename, 'wb') as fp:
+      fp.write(audio)
+
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text='Artist {}'.format(artist)))
+    tags.add(TPE2(encoding=3, text='Artist {}'.format(artist)))
+    tags.add(TALB(encoding=3, text=album_title))
+    tags.add(TCON(encoding=3, text=genre))
+    tags.add(TDRC(encoding=3, text=year))
+    tags.add(TRCK(encoding=3, text='{}/10'.format(number)))
+    if cover:
+      tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='', data=cover))
+    tags.save(filename)
+    filenames.append(filename)
+
+  return filenames
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Generates a synthetic music library.')
+  parser.add_argument('root')
+  parser.add_argument('count', type=int)
+  parser.add_argument('--cover-size', type=int, default=64 * 1024,
+    help='size of the embedded covers in bytes (default: 64 KiB)')
+  parser.add_argument('--duration', type=float, default=2.0,
+    help='duration of the tracks in seconds (default: 2)')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  generate(args.root, args.count, args.cover_size, args.duration, args.seed)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,161 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from generate import generate
+from mutagen.id3 import ID3, TIT2
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.dirname(here)
+
+CONFIG = '''
+exec(open({config!r}).read())
+library_root = {root!r}
+database_url = 'sqlite:///' + {database!r}
+cover_cache_dir = {covers!r}
+metadata_cache = None
+'''
+
+
+def write_config(dirname, root):
+  with open(os.path.join(dirname, 'qu_config.py'), 'w') as fp:
+    fp.write(CONFIG.format(config=os.path.join(repo, 'qu_config.py'), root=root,
+      database=os.path.join(dirname, 'database.sqlite'),
+      covers=os.path.join(dirname, 'covers')))
+
+
+def run_case(dirname, case, *args):
+  """
+  Runs a case from cases.py in a subprocess with the qu_config in
+  *dirname* and returns its result.
+  """
+
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([dirname, repo])
+  output = subprocess.check_output([sys.executable, os.path.join(here, 'cases.py'),
+    case] + [str(x) for x in args], env=env, cwd=dirname)
+  return json.loads(output.decode('utf8'))
+
+
+def change_files(filenames, fraction, seed=0):
+  """
+  Changes the title tag of a *fraction* of the *filenames*.
+  """
+
+  rng = random.Random(seed)
+  changed = rng.sample(filenames, max(1, int(len(filenames) * fraction)))
+  for filename in changed:
+    tags = ID3(filename)
+    tags.add(TIT2(encoding=3, text='Changed'))
+    tags.save(filename)
+  return len(changed)
+
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo,
+      stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def benchmark(size, args, log):
+  dirname = tempfile.mkdtemp(prefix='qu-bench-')
+  try:
+    root = os.path.join(dirname, 'library')
+    log('generating {} files in {}'.format(size, root))
+    filenames = generate(root, size, args.cover_size, args.duration)
+    write_config(dirname, root)
+
+    results = {}
+    log('syncdb_cold')
+    results['syncdb_cold'] = run_case(dirname, 'syncdb', 0, args.jobs)
+    log('syncdb_noop')
+    results['syncdb_noop'] = run_case(dirname, 'syncdb', 0, args.jobs)
+
+    # Changing files in-place doesn't change their directories, so this
+    # resync must check all files even with sync_skip_directories.
+    changed = change_files(filenames, 0.01)
+    log('syncdb_changed ({} files)'.format(changed))
+    results['syncdb_changed'] = run_case(dirname, 'syncdb', 1, args.jobs)
+    results['syncdb_changed']['changed_files'] = changed
+
+    for case in ('home', 'pic', 'stream'):
+      log(case)
+      results[case] = run_case(dirname, case)
+    return results
+  finally:
+    if args.keep:
+      log('kept {}'.format(dirname))
+    else:
+      shutil.rmtree(dirname)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Runs the qu benchmarks '
+    'against synthetic libraries and writes the results as JSON.')
+  parser.add_argument('--sizes', default='1000,10000,100000',
+    help='comma separated library sizes (default: 1000,10000,100000)')
+  parser.add_argument('--cover-size', type=int, default=64 * 1024,
+    help='size of the embedded covers in bytes (default: 64 KiB)')
+  parser.add_argument('--duration', type=float, default=2.0,
+    help='duration of the tracks in seconds (default: 2)')
+  parser.add_argument('--jobs', type=int, default=1,
+    help='number of worker processes for syncdb')
+  parser.add_argument('--output', '-o', help='output file (default: stdout)')
+  parser.add_argument('--keep', action='store_true',
+    help='keep the generated libraries')
+  args = parser.parse_args()
+
+  def log(message):
+    print('[bench]', message, file=sys.stderr)
+
+  results = {
+    'revision': git_revision(),
+    'date': datetime.datetime.utcnow().isoformat() + 'Z',
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'parameters': {'cover_size': args.cover_size, 'duration': args.duration,
+      'jobs': args.jobs},
+    'results': {},
+  }
+  for size in map(int, args.sizes.split(',')):
+    results['results'][str(size)] = benchmark(size, args, log)
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+  else:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+  main()
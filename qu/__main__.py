@@ -20,6 +20,7 @@
 
 from . import config
 import argparse
+import logging
 import sys, os
 import subprocess
 
@@ -28,16 +29,81 @@ def main():
   parser = argparse.ArgumentParser()
   parser.add_argument('--syncdb', action='store_true')
   parser.add_argument('--web', action='store_true')
+  parser.add_argument('--build-thumbnails', action='store_true',
+    help='render the cover art thumbnails (requires Pillow)')
+  parser.add_argument('--index-audio', action='store_true',
+    help='index the audio frames of the tracks that have no index yet, see '
+      'sync_audio_index (reads the whole files)')
+  parser.add_argument('--watch', action='store_true',
+    help='synchronize the database and keep it up to date continuously')
+  parser.add_argument('--async', dest='use_async', action='store_true',
+    help='serve --web with the asyncio server for many concurrent streams')
+  parser.add_argument('--workers', type=int, default=1, metavar='N',
+    help='number of --web worker processes that share the listening socket')
+  parser.add_argument('--explain', action='store_true',
+    help='log the query plans of the database queries in --web')
+  parser.add_argument('--jobs', type=int, default=1, metavar='N',
+    help='number of worker processes for --syncdb, --index-audio and '
+      '--build-thumbnails')
+  parser.add_argument('--full', action='store_true',
+    help='check all files in --syncdb, even if sync_skip_directories is enabled '
+      '(which misses files that were changed in-place)')
+  parser.add_argument('--report', choices=['json'],
+    help='print a performance report of --syncdb to stdout')
   args = parser.parse_args()
 
-  if args.syncdb:
-    from .database import syncdb
-    syncdb()
+  if args.syncdb or args.index_audio or args.build_thumbnails:
+    from .database import init, syncdb, index_audio, build_thumbnails
+    init()
+    if args.syncdb:
+      # Keep stdout clean for the report.
+      progress = sys.stderr if args.report else sys.stdout
+      report = syncdb(jobs=args.jobs, full=args.full, progress=progress)
+      if args.report == 'json':
+        import json
+        print(json.dumps(report.to_dict(), indent=2))
+    if args.index_audio:
+      index_audio(jobs=args.jobs)
+    if args.build_thumbnails:
+      build_thumbnails(jobs=args.jobs)
+    return 0
+
+  if args.watch:
+    from .watch import watch
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    try:
+      watch(jobs=args.jobs)
+    except KeyboardInterrupt:
+      pass
     return 0
 
   if args.web:
-    from .web import app
-    app.run(host=config.host, port=config.port, debug=False)
+    from .database import init
+    init()
+    if args.explain:
+      from .database import explain_queries
+      logging.basicConfig(level=logging.INFO)
+      explain_queries()
+    from .web import create_app
+    app = create_app()
+    if args.use_async or args.workers > 1:
+      logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if args.use_async:
+      from .web.asyncserver import serve
+    if args.workers > 1:
+      from .web import prefork
+      sock = prefork.listen(config.host, config.port)
+      if args.use_async:
+        target = lambda: serve(app, config.host, config.port, config.async_threads,
+          config.async_keepalive_timeout, sock=sock)
+      else:
+        target = lambda: prefork.serve_threaded(app, sock)
+      prefork.run_workers(args.workers, target)
+    elif args.use_async:
+      serve(app, config.host, config.port, config.async_threads,
+        config.async_keepalive_timeout)
+    else:
+      app.run(host=config.host, port=config.port, debug=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,165 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from . import config
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+# The umask of the process. #tempfile.mkstemp() creates files that only
+# the owner can read, but the web app may run as a different user than
+# --syncdb, so the files in the store get the default permissions.
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def get_digest(data):
+  """
+  Returns the content hash of the cover art *data* that is used to
+  identify it in the cover store.
+  """
+
+  return hashlib.sha1(data).hexdigest()
+
+
+def get_filename(digest):
+  """
+  Returns the filename of the cover art with the specified *digest*
+  in the cover store.
+  """
+
+  return os.path.join(config.cover_cache_dir, digest[:2], digest)
+
+
+def get_thumbnail_filename(digest, size):
+  """
+  Returns the filename of the thumbnail of the cover art with the
+  specified *digest* that fits into *size* x *size* pixels.
+  """
+
+  return '{}.{}.jpg'.format(get_filename(digest), size)
+
+
+def find_thumbnail(digest, size):
+  """
+  Returns a tuple of the size and filename of the smallest thumbnail of
+  the cover art with the specified *digest* that is at least *size*
+  pixels large, or None if there is no such thumbnail and the original
+  should be used.
+  """
+
+  for thumb_size in sorted(config.cover_thumbnail_sizes):
+    if thumb_size >= size:
+      filename = get_thumbnail_filename(digest, thumb_size)
+      if os.path.isfile(filename):
+        return thumb_size, filename
+      break
+  return None
+
+
+def _write_file(filename, data):
+  dirname = os.path.dirname(filename)
+  os.makedirs(dirname, exist_ok=True)
+  fd, tempname = tempfile.mkstemp(dir=dirname)
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(data)
+    os.chmod(tempname, 0o666 & ~_umask)
+    os.replace(tempname, filename)
+  except:
+    os.remove(tempname)
+    raise
+
+
+def contains(digest):
+  """
+  Returns True if the cover store contains the cover art with the
+  specified *digest*.
+  """
+
+  return os.path.isfile(get_filename(digest))
+
+
+def store(cover):
+  """
+  Writes the data of the #metadata.MimeData object *cover* to the cover
+  store unless it already contains the same data. Returns the digest
+  of the data.
+  """
+
+  digest = get_digest(cover.data)
+  if not contains(digest):
+    _write_file(get_filename(digest), cover.data)
+  return digest
+
+
+def build_thumbnails(digest, sizes=None):
+  """
+  Renders the thumbnails of the cover art with the specified *digest*
+  in all *sizes* that don't exist yet. If *sizes* is None, it defaults
+  to the `cover_thumbnail_sizes` configuration value. Returns the number
+  of thumbnails that were created. Requires Pillow.
+  """
+
+  if Image is None:
+    raise RuntimeError('Pillow is required to build cover thumbnails')
+  if sizes is None:
+    sizes = config.cover_thumbnail_sizes
+
+  missing = [x for x in sizes if not os.path.isfile(get_thumbnail_filename(digest, x))]
+  if not missing:
+    return 0
+
+  try:
+    image = Image.open(get_filename(digest))
+    image.load()
+  except (IOError, OSError, SyntaxError):
+    return 0
+  if image.mode != 'RGB':
+    image = image.convert('RGB')
+
+  for size in sorted(missing, reverse=True):
+    image.thumbnail((size, size), Image.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=85, optimize=True)
+    _write_file(get_thumbnail_filename(digest, size), buf.getvalue())
+  return len(missing)
+
+
+def build_all_thumbnails(digests, jobs=1):
+  """
+  Builds the thumbnails for all cover art *digests*, distributing the
+  work to a pool of *jobs* worker processes. Yields the number of
+  thumbnails that were created for every digest.
+  """
+
+  if jobs <= 1:
+    yield from map(build_thumbnails, digests)
+    return
+
+  with multiprocessing.Pool(jobs) as pool:
+    yield from pool.imap_unordered(build_thumbnails, digests, chunksize=4)
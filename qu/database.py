@@ -18,14 +18,142 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from . import config, orm, metadata, pathutils
+from . import config, orm, metadata, metrics, pathutils, covers
+from .syncreport import SyncReport, Progress
+from .metadata_cache import MISSING
 import os, sys
+import posixpath
+import re
+import hashlib
+import itertools
 import logging
+import multiprocessing
+import threading
 import time
 
-engine = orm.new_engine(config.database_url, encoding=config.database_encoding)
+# The engine is created by #init(), which happens implicitly when the
+# first #Session is created.
+engine = None
+fts_available = False
+_init_lock = threading.Lock()
 Entity = orm.new_entity()
-Session = orm.Session.bind(engine)
+Session = orm.Session.bind(lambda: get_engine())
+logger = logging.getLogger(__name__)
+
+
+def init(database_url=None):
+  """
+  Creates the #engine for *database_url* (defaults to the `database_url`
+  configuration value) and brings the database schema up to date, see
+  #migrate(). Does nothing if the engine was already created. Safe to
+  call from multiple threads.
+  """
+
+  with _init_lock:
+    if engine is None:
+      _init(database_url)
+  return engine
+
+
+def _init(database_url):
+  global engine, fts_available
+  database_url = database_url or config.database_url
+  options = {'encoding': config.database_encoding}
+  if not database_url.startswith('sqlite'):
+    options['pool_size'] = config.database_pool_size
+    options['max_overflow'] = config.database_max_overflow
+  new_engine = orm.new_engine(database_url, **options)
+  orm.event.listen(new_engine, 'connect', set_sqlite_pragmas)
+  orm.event.listen(new_engine, 'before_cursor_execute', start_query_timer)
+  orm.event.listen(new_engine, 'after_cursor_execute', record_query_time)
+  orm.event.listen(new_engine, 'handle_error', discard_query_timer)
+  migrate(new_engine)
+  fts_available = create_search_index(new_engine)
+  engine = new_engine
+
+
+def get_engine():
+  """
+  Returns the #engine, calling #init() if it was not created yet.
+  """
+
+  return engine if engine is not None else init()
+
+
+def recreate_pool():
+  """
+  Replaces the connection pool of the #engine with a new, empty pool
+  without closing the connections of the old one. Called in every
+  forked child process so that it never uses the connections of its
+  parent, which are still in use by the parent.
+  """
+
+  if engine is not None:
+    engine.pool = engine.pool.recreate()
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=recreate_pool)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+  """
+  Applies the `sqlite_pragmas` configuration to new SQLite connections.
+  """
+
+  if not type(dbapi_connection).__module__.startswith('sqlite3'):
+    return
+  cursor = dbapi_connection.cursor()
+  for name, value in config.sqlite_pragmas.items():
+    cursor.execute('PRAGMA {} = {}'.format(name, value))
+  cursor.close()
+
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+  metrics.record_query(time.perf_counter() - conn.info['query_start_time'].pop())
+
+
+def discard_query_timer(context):
+  if context.connection is not None and context.connection.info.get('query_start_time'):
+    context.connection.info['query_start_time'].pop()
+
+
+# The orders in which #Track.browse() can sort tracks, each mapping to
+# the columns that are sorted by. The track ID is always sorted by last.
+# Missing values of these columns are stored as empty strings so that
+# they remain comparable for keyset pagination.
+BROWSE_COLUMNS = ('title', 'artist', 'album', 'grouping', 'genre')
+BROWSE_ORDERS = {
+  'default': ('grouping', 'artist', 'album', 'title'),
+  'title': ('title', 'artist', 'album'),
+  'artist': ('artist', 'album', 'title'),
+  'album': ('album', 'artist', 'title'),
+  'genre': ('genre', 'artist', 'album', 'title'),
+}
+
+# Columns that describe the audio stream. They are reset when a file no
+# longer yields them.
+AUDIO_COLUMNS = ('duration', 'bitrate', 'audio_offset', 'audio_length',
+  'seek_table')
+
+
+
+def get_sync_fields():
+  """
+  Returns the metadata fields that are read when synchronizing the
+  database. The audio frames are only indexed with `sync_audio_index`.
+  The data of the cover art is only read if the cover store doesn't
+  have it yet, see #Track.update_metadata().
+  """
+
+  fields = {metadata.TAGS, metadata.COVER}
+  if config.sync_audio_index:
+    fields.add(metadata.AUDIO)
+  return frozenset(fields)
 
 
 class Track(Entity):
@@ -40,6 +168,10 @@ class Track(Entity):
   # Time the track information was last updated.
   last_update_time = orm.int()
 
+  # Size and modification time of the file when it was last updated.
+  size = orm.bigint()
+  mtime = orm.float()
+
   # Metadata.
   title = orm.unicode()
   artist = orm.unicode()
@@ -57,21 +189,595 @@ class Track(Entity):
   codec = orm.unicode()
   encoded_by = orm.unicode()
 
+  # Exact duration in seconds, average bitrate in bits per second, the
+  # location of the audio frames in the file (without leading and
+  # trailing tags) and the seek table of the audio stream, see
+  # #metadata.pack_seek_table().
+  duration = orm.float()
+  bitrate = orm.int()
+  audio_offset = orm.bigint()
+  audio_length = orm.bigint()
+  seek_table = orm.blob()
+
   # True if the track has a covert art.
   has_cover = orm.bool()
 
+  # Content hash and mime type of the cover art in the cover store.
+  cover_hash = orm.string()
+  cover_mime = orm.string()
+
+  # The normalized artist, album and genre, see #Catalogue.
+  artist_id = orm.int(orm.foreign_key('artist.id'), index=True)
+  album_id = orm.int(orm.foreign_key('album.id'), index=True)
+  genre_id = orm.int(orm.foreign_key('genre.id'), index=True)
+
+  # Indexes for the #BROWSE_ORDERS, which also serve filtering by the
+  # leading column. They end with the ID for keyset pagination.
+  ix_browse_default = orm.index(grouping, artist, album, title, id)
+  ix_browse_title = orm.index(title, artist, album, id)
+  ix_browse_artist = orm.index(artist, album, title, id)
+  ix_browse_album = orm.index(album, artist, title, id)
+  ix_browse_genre = orm.index(genre, artist, album, title, id)
+
+  # Covers the path index that syncdb loads and the cover lookups.
+  ix_sync = orm.index(path, include=[id, last_update_time])
+  ix_cover_hash = orm.index(cover_hash)
+
   @staticmethod
   def get(filename, or_create=False):
     session = Session.current()
-    path = os.path.relpath(filename, config.library_root)
-    path = pathutils.to_dbpath(path)
+    path = get_dbpath(filename)
     track = session.query(Track).filter_by(path=path).one_or_none()
     if track is None and or_create:
       track = Track(path=path)
     return track
 
+  @staticmethod
+  def load_index():
+    """
+    Loads the path, ID and last update time of all tracks with a single
+    query. Returns a dictionary that maps the database path of every
+    track to an `(id, last_update_time)` tuple.
+    """
+
+    session = Session.current()
+    query = session.query(Track.path, Track.id, Track.last_update_time)
+    return {path: (id, mtime) for path, id, mtime in query}
+
+  @staticmethod
+  def get_browse_key(sort):
+    """
+    Returns the list of columns that tracks are sorted by in the browse
+    order *sort*.
+    """
+
+    return [getattr(Track, x) for x in BROWSE_ORDERS[sort]] + [Track.id]
+
+  @staticmethod
+  def browse(sort='default', descending=False, filters=None, after=None, limit=100):
+    """
+    Returns a list of up to *limit* tracks in the browse order *sort*
+    that match the column values in the *filters* dictionary. Pages are
+    selected with keyset pagination, *after* being the sort key of the
+    last track of the previous page.
+
+    :return: A tuple of the list of tracks and the sort key of the last
+      track, or None if there are no more tracks.
+    """
+
+    session = Session.current()
+    key = Track.get_browse_key(sort)
+    query = session.query(Track)
+    for name, value in (filters or {}).items():
+      query = query.filter(getattr(Track, name) == value)
+    if after is not None:
+      if descending:
+        query = query.filter(orm.tuple_(*key) < orm.tuple_(*after))
+      else:
+        query = query.filter(orm.tuple_(*key) > orm.tuple_(*after))
+    if descending:
+      key = [orm.desc(x) for x in key]
+    tracks = query.order_by(*key).limit(limit).all()
+
+    if len(tracks) < limit:
+      return tracks, None
+    last = tracks[-1]
+    columns = BROWSE_ORDERS[sort]
+    return tracks, [getattr(last, x) or '' for x in columns] + [last.id]
+
+  @staticmethod
+  def search(query, limit=50):
+    """
+    Returns a list of up to *limit* tracks that contain all words in the
+    *query* string, where the last word may be incomplete, in any of
+    the #SEARCH_COLUMNS. Uses the FTS5 table if available.
+    """
+
+    session = Session.current()
+    words = re.findall(r'\w+', query)
+    if not words:
+      return []
 
-Entity.metadata.create_all(engine)
+    if not fts_available:
+      conditions = []
+      for word in words:
+        pattern = '%' + word.replace('_', '\\_') + '%'
+        conditions.append(orm.or_(*[getattr(Track, x).like(pattern, escape='\\')
+          for x in SEARCH_COLUMNS]))
+      return session.query(Track).filter(*conditions).limit(limit).all()
+
+    # Every word is matched as a prefix so that results appear while
+    # the user is typing. Ranking requires all matches to be scored,
+    # which we avoid for very short prefixes that match a lot of tracks.
+    match = ' '.join('"{}"*'.format(x) for x in words)
+    sql = 'SELECT rowid FROM track_search WHERE track_search MATCH :match'
+    if min(map(len, words)) >= 3:
+      sql += ' ORDER BY rank'
+    sql += ' LIMIT :limit'
+    ids = [x for x, in session.execute(sql, {'match': match, 'limit': limit})]
+    if not ids:
+      return []
+    tracks = {x.id: x for x in session.query(Track).filter(Track.id.in_(ids))}
+    return [tracks[x] for x in ids if x in tracks]
+
+  def get_etag(self):
+    """
+    Returns an entity tag for the file of the track that is derived from
+    its path, size and modification time as of the last update.
+    """
+
+    key = '{}\0{}\0{!r}'.format(self.path, self.size, self.mtime)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()[:20]
+
+  def update_metadata(self, data, stat, current_time=None):
+    """
+    Transfers the metadata dictionary *data* as returned by
+    #metadata.read_metadata() and the size and modification time from
+    the #os.stat_result *stat* of the file to the track. If *data*
+    contains the cover art without its data and the cover store doesn't
+    have it yet, the data is read from the file.
+    """
+
+    self.size = stat.st_size
+    self.mtime = stat.st_mtime
+
+    for key, value in data.items():
+      if hasattr(self, key):
+        setattr(self, key, value)
+    for key in BROWSE_COLUMNS:
+      setattr(self, key, data.get(key) or '')
+    for key in AUDIO_COLUMNS:
+      setattr(self, key, data.get(key))
+    cover = data.get('cover')
+    if cover and cover.data is None and not covers.contains(cover.digest):
+      filename = os.path.join(config.library_root, pathutils.from_dbpath(self.path))
+      cover = (metadata.read_metadata(filename, {metadata.COVER_DATA}) or {}).get('cover')
+    self.has_cover = bool(cover)
+    if cover:
+      self.cover_hash = covers.store(cover) if cover.data is not None else cover.digest
+    else:
+      self.cover_hash = None
+    self.cover_mime = cover.mime if cover else None
+    if current_time is None:
+      current_time = time.time()
+    self.last_update_time = current_time
+
+
+class Artist(Entity):
+  id = orm.int(primary_key=True)
+  name = orm.unicode(unique=True)
+
+  # Number of tracks by the artist and their total file size.
+  track_count = orm.int(default=0)
+  total_size = orm.bigint(default=0)
+
+
+class Album(Entity):
+  id = orm.int(primary_key=True)
+  title = orm.unicode()
+
+  # The album artist, which is the grouping or artist of its tracks.
+  artist_id = orm.int(orm.foreign_key('artist.id'))
+  ix_artist_title = orm.index(artist_id, title, unique=True)
+
+  # Number of tracks on the album, their total file size and the
+  # cover art hash of one of them.
+  track_count = orm.int(default=0)
+  total_size = orm.bigint(default=0)
+  cover_hash = orm.string()
+
+
+class Genre(Entity):
+  id = orm.int(primary_key=True)
+  name = orm.unicode(unique=True)
+
+  # Number of tracks in the genre.
+  track_count = orm.int(default=0)
+
+
+class Catalogue(object):
+  """
+  Interns the artist, album and genre names of tracks into #Artist,
+  #Album and #Genre entities and keeps the aggregates of these entities
+  up to date. Call #assign() for every track that is added or changed,
+  #forget() before tracks are deleted and #refresh() before committing.
+  Only the aggregates of the entities that tracks were assigned to or
+  removed from are recomputed, entities without tracks are deleted.
+  """
+
+  def __init__(self, session):
+    self.session = session
+    self.cache = {}
+    self.dirty = {Artist: set(), Album: set(), Genre: set()}
+
+  def intern(self, entity, **key):
+    """
+    Returns the ID of the *entity* with the specified column values,
+    creating it if it does not exist.
+    """
+
+    cache_key = (entity,) + tuple(sorted(key.items()))
+    id = self.cache.get(cache_key)
+    if id is None:
+      id = self.session.query(entity.id).filter_by(**key).scalar()
+      if id is None:
+        obj = entity(**key)
+        self.session.add(obj)
+        self.session.flush()
+        id = obj.id
+      self.cache[cache_key] = id
+    return id
+
+  def assign(self, track):
+    """
+    Assigns the #Track to the artist, album and genre entities that
+    match its metadata.
+    """
+
+    self._mark(track.artist_id, track.album_id, track.genre_id)
+    album_artist = track.grouping or track.artist
+    track.artist_id = self.intern(Artist, name=track.artist) if track.artist else None
+    track.genre_id = self.intern(Genre, name=track.genre) if track.genre else None
+    track.album_id = None
+    if track.album:
+      artist_id = self.intern(Artist, name=album_artist) if album_artist else None
+      track.album_id = self.intern(Album, artist_id=artist_id, title=track.album)
+    self._mark(track.artist_id, track.album_id, track.genre_id)
+
+  def forget(self, ids):
+    """
+    Must be called with the IDs of tracks before they are deleted.
+    """
+
+    query = self.session.query(Track.artist_id, Track.album_id, Track.genre_id)
+    for row in query.filter(Track.id.in_(ids)):
+      self._mark(*row)
+
+  def _mark(self, artist_id, album_id, genre_id):
+    for entity, id in ((Artist, artist_id), (Album, album_id), (Genre, genre_id)):
+      if id is not None:
+        self.dirty[entity].add(id)
+
+  def refresh(self, batch_size=500):
+    """
+    Recomputes the aggregates of all entities that were affected since
+    the last refresh and deletes the ones that no longer have tracks.
+    """
+
+    self.session.flush()
+    track = Track.__table__
+
+    def tracks_of(column, entity, func):
+      return orm.select([func]).where(column == entity.id).as_scalar()
+
+    # Albums first, as deleting them can leave their artists empty.
+    for ids in chunks(self.dirty[Album], batch_size):
+      self.session.execute(Album.__table__.update().where(Album.id.in_(ids)).values(
+        track_count=tracks_of(track.c.album_id, Album, orm.func.count()),
+        total_size=tracks_of(track.c.album_id, Album, orm.func.coalesce(orm.func.sum(track.c.size), 0)),
+        cover_hash=tracks_of(track.c.album_id, Album, orm.func.max(track.c.cover_hash))))
+      query = self.session.query(Album.id, Album.artist_id).filter(
+        Album.id.in_(ids), Album.track_count == 0)
+      empty = query.all()
+      if empty:
+        self.dirty[Artist].update(x.artist_id for x in empty)
+        self.session.query(Album).filter(Album.id.in_([x.id for x in empty]))\
+          .delete(synchronize_session=False)
+
+    for ids in chunks(self.dirty[Artist], batch_size):
+      self.session.execute(Artist.__table__.update().where(Artist.id.in_(ids)).values(
+        track_count=tracks_of(track.c.artist_id, Artist, orm.func.count()),
+        total_size=tracks_of(track.c.artist_id, Artist, orm.func.coalesce(orm.func.sum(track.c.size), 0))))
+      self.session.query(Artist).filter(Artist.id.in_(ids), Artist.track_count == 0,
+        ~orm.exists().where(Album.artist_id == Artist.id)).delete(synchronize_session=False)
+
+    for ids in chunks(self.dirty[Genre], batch_size):
+      self.session.execute(Genre.__table__.update().where(Genre.id.in_(ids)).values(
+        track_count=tracks_of(track.c.genre_id, Genre, orm.func.count())))
+      self.session.query(Genre).filter(Genre.id.in_(ids), Genre.track_count == 0)\
+        .delete(synchronize_session=False)
+
+    # Deleted entities must not be returned from the cache anymore.
+    for entity in self.dirty:
+      self.dirty[entity] = set()
+    self.cache.clear()
+
+
+class Committer(object):
+  """
+  Commits the changes of a long-running synchronization in the *session*
+  after every *files* files or *interval* seconds, so that other
+  connections are not blocked and a crash keeps the progress made so
+  far. The aggregates of the #Catalogue are refreshed before every
+  commit.
+  """
+
+  def __init__(self, session, catalogue, files, interval):
+    self.session = session
+    self.catalogue = catalogue
+    self.files = files
+    self.interval = interval
+    self.count = 0
+    self.last_commit = time.time()
+
+  def tick(self, count=1):
+    """
+    Records that *count* files were written and commits if a limit is
+    reached.
+    """
+
+    self.count += count
+    if self.count >= self.files or time.time() - self.last_commit >= self.interval:
+      self.commit()
+
+  def commit(self):
+    self.catalogue.refresh()
+    self.session.commit()
+    self.count = 0
+    self.last_commit = time.time()
+
+
+class Directory(Entity):
+  id = orm.int(primary_key=True)
+
+  # Path to the directory relative to the library root directory.
+  path = orm.unicode(unique=True)
+
+  # Modification time and number of entries of the directory when
+  # its files were last synchronized.
+  mtime = orm.float()
+  entry_count = orm.int()
+
+  @staticmethod
+  def load_index():
+    """
+    Returns a dictionary that maps the database path of every directory
+    to an `(id, mtime, entry_count)` tuple.
+    """
+
+    session = Session.current()
+    query = session.query(Directory.path, Directory.id,
+      Directory.mtime, Directory.entry_count)
+    return {path: (id, mtime, count) for path, id, mtime, count in query}
+
+
+# Columns of #Track that are indexed for full-text search.
+SEARCH_COLUMNS = ('title', 'artist', 'album', 'composer', 'genre')
+
+_search_ddl = [
+  """CREATE VIRTUAL TABLE track_search USING fts5({columns},
+    content='track', content_rowid='id', prefix='2 3',
+    tokenize='unicode61 remove_diacritics 1')""",
+  """CREATE TRIGGER track_search_insert AFTER INSERT ON track BEGIN
+    INSERT INTO track_search(rowid, {columns}) VALUES (new.id, {new});
+  END""",
+  """CREATE TRIGGER track_search_delete AFTER DELETE ON track BEGIN
+    INSERT INTO track_search(track_search, rowid, {columns})
+      VALUES ('delete', old.id, {old});
+  END""",
+  """CREATE TRIGGER track_search_update AFTER UPDATE OF {columns} ON track BEGIN
+    INSERT INTO track_search(track_search, rowid, {columns})
+      VALUES ('delete', old.id, {old});
+    INSERT INTO track_search(rowid, {columns}) VALUES (new.id, {new});
+  END""",
+  """INSERT INTO track_search(track_search) VALUES ('rebuild')""",
+]
+
+
+def create_search_index(engine):
+  """
+  Creates the SQLite FTS5 table `track_search` over the #SEARCH_COLUMNS
+  of #Track in the database of *engine*, unless it exists already. The
+  table is kept in sync with the `track` table by triggers, thus all
+  writes to tracks update it. Returns False if the database does not
+  support FTS5, in which case #Track.search() falls back to `LIKE`
+  queries.
+  """
+
+  if engine.dialect.name != 'sqlite':
+    return False
+
+  exists_query = ("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+    "AND name = 'track_search'")
+  with engine.begin() as conn:
+    if conn.execute(exists_query).scalar():
+      return True
+    names = {
+      'columns': ', '.join(SEARCH_COLUMNS),
+      'new': ', '.join('new.' + x for x in SEARCH_COLUMNS),
+      'old': ', '.join('old.' + x for x in SEARCH_COLUMNS),
+    }
+    try:
+      conn.execute(_search_ddl[0].format(**names))
+    except orm.exc.OperationalError:
+      # Another process may have created the table in the meantime.
+      if conn.execute(exists_query).scalar():
+        return True
+      logger.warning('SQLite FTS5 is not available, searching will be slow')
+      return False
+    for statement in _search_ddl[1:]:
+      conn.execute(statement.format(**names))
+  return True
+
+
+class SchemaVersion(Entity):
+  __tablename__ = 'schema_version'
+  version = orm.int(primary_key=True)
+
+
+# The version of the database schema. Increase it when a column, index
+# or table is added, and add a data migration below if existing rows
+# need to be updated.
+SCHEMA_VERSION = 1
+
+
+def _fill_browse_columns(conn):
+  # Databases from before the browse columns were stored as '' for
+  # missing values contain NULLs that break keyset pagination.
+  for name in BROWSE_COLUMNS:
+    conn.execute('UPDATE track SET {0} = \'\' WHERE {0} IS NULL'.format(name))
+
+
+def _resync_all(conn):
+  # The columns that were added are empty for existing tracks, but the
+  # files are unchanged since they were last synchronized. Make the next
+  # sync read all of them again.
+  conn.execute('UPDATE track SET last_update_time = 0')
+  conn.execute('DELETE FROM directory')
+
+
+# Data migrations as tuples of the schema version they were introduced
+# in and a function that is called with the connection.
+DATA_MIGRATIONS = [
+  (1, _fill_browse_columns),
+  (1, _resync_all),
+]
+
+
+def _get_schema_version(conn):
+  try:
+    return conn.execute('SELECT MAX(version) FROM schema_version').scalar() or 0
+  except orm.exc.DBAPIError:
+    return 0
+
+
+def migrate(engine):
+  """
+  Brings the schema of the database of *engine* up to #SCHEMA_VERSION.
+  Missing tables, columns and indexes are created and the
+  #DATA_MIGRATIONS newer than the database are run. If the database is
+  up to date, this costs a single query.
+  """
+
+  with engine.begin() as conn:
+    current = _get_schema_version(conn)
+  if current == SCHEMA_VERSION:
+    return
+
+  with engine.begin() as conn:
+    if engine.dialect.name == 'sqlite':
+      # Take the write lock before looking at the schema, so that
+      # processes that start at the same time migrate one after another.
+      conn.execute('BEGIN IMMEDIATE')
+      current = _get_schema_version(conn)
+      if current == SCHEMA_VERSION:
+        return
+    if current > SCHEMA_VERSION:
+      raise RuntimeError('database schema version {} is newer than this version '
+        'of qu supports ({})'.format(current, SCHEMA_VERSION))
+
+    logger.info('migrating database schema from version %d to %d', current, SCHEMA_VERSION)
+    inspector = orm.inspect(conn)
+    tables = set(inspector.get_table_names())
+    for table in Entity.metadata.sorted_tables:
+      if table.name not in tables:
+        table.create(conn)
+        continue
+      columns = set(x['name'] for x in inspector.get_columns(table.name))
+      for column in table.columns:
+        if column.name not in columns:
+          type_ = column.type.compile(dialect=engine.dialect)
+          conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, column.name, type_))
+      indexes = set(x['name'] for x in inspector.get_indexes(table.name))
+      for index in table.indexes:
+        if index.name not in indexes:
+          index.create(conn)
+
+    for version, func in DATA_MIGRATIONS:
+      if version > current:
+        func(conn)
+    conn.execute(SchemaVersion.__table__.delete())
+    conn.execute(SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION))
+
+def explain_queries():
+  """
+  Logs the query plan of every SELECT statement that is executed on
+  the #engine. Used for debugging which indexes the queries use.
+  """
+
+  engine = get_engine()
+  if engine.dialect.name == 'sqlite':
+    prefix = 'EXPLAIN QUERY PLAN '
+  else:
+    prefix = 'EXPLAIN '
+
+  @orm.event.listens_for(engine, 'before_cursor_execute')
+  def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if executemany or not statement.lstrip().upper().startswith('SELECT'):
+      return
+    explain = conn.connection.cursor()
+    try:
+      explain.execute(prefix + statement, parameters)
+      plan = '\n'.join('  ' + ' '.join(map(str, row)) for row in explain.fetchall())
+    finally:
+      explain.close()
+    logger.info('%s\n%s', statement, plan)
+
+
+def get_dbpath(filename):
+  """
+  Returns the path of *filename* relative to the library root directory
+  in the format that is stored in the database.
+  """
+
+  path = os.path.relpath(filename, config.library_root)
+  path = pathutils.to_dbpath(path)
+  return '' if path == '.' else path
+
+
+def in_subtree(column, path):
+  """
+  Returns a filter expression that matches if the database path in
+  *column* equals *path* or is located in the directory *path*.
+  """
+
+  if not path:
+    return orm.true()
+
+  if get_engine().dialect.name != 'sqlite':
+    # Other databases may compare strings with a locale collation that
+    # ignores punctuation, which breaks the range below.
+    pattern = re.sub(r'([\\%_])', r'\\\1', path)
+    return orm.or_(column == path, column.like(pattern + '/%', escape='\\'))
+
+  # '0' is the character that follows '/', thus all paths in the
+  # directory sort between these two strings.
+  return orm.or_(column == path, orm.and_(
+    column >= path + '/', column < path + '0'))
+
+
+def chunks(iterable, size):
+  """
+  Yields lists of up to *size* items from *iterable*.
+  """
+
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, size))
+    if not chunk:
+      break
+    yield chunk
 
 
 def check_skip_track(filename):
@@ -96,59 +802,359 @@ def check_skip_track(filename):
   return True
 
 
+def _read_metadata(filename):
+  """
+  Worker function for #syncdb() that reads the metadata of *filename*.
+  Returns a tuple of the *filename*, the metadata and the time it took
+  to read in seconds, so results can be matched up when they arrive
+  out of order.
+  """
+
+  start = time.perf_counter()
+  data = metadata.read_metadata(filename, get_sync_fields(), use_cache=False)
+  return filename, data, time.perf_counter() - start
+
+
+def read_metadata_all(files, jobs=1):
+  """
+  Reads the metadata of all *files*, a dictionary that maps filenames
+  to their #os.stat_result, and yields `(filename, data, seconds)`
+  tuples. If *jobs* is greater than one, the files are distributed to
+  a pool of *jobs* worker processes and the results are yielded in the
+  order they are completed.
+
+  If the #metadata.MetadataCache is enabled, the cached results are
+  yielded first (with *seconds* being None) and only the remaining
+  files are read. Only the calling process writes to the cache.
+  """
+
+  cache = metadata.get_cache()
+  fields = get_sync_fields()
+  keys = {}
+  misses = []
+  for filename, stat in files.items():
+    key = metadata.get_cache_key(filename, fields, stat) if cache else None
+    data = cache.get(key) if key is not None else MISSING
+    if data is MISSING:
+      keys[filename] = key
+      misses.append(filename)
+    else:
+      yield filename, data, None
+
+  if jobs <= 1:
+    results = map(_read_metadata, misses)
+  else:
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap_unordered(_read_metadata, misses, chunksize=16)
+  try:
+    for filename, data, seconds in results:
+      if keys[filename] is not None:
+        cache.put(keys[filename], data)
+      yield filename, data, seconds
+  finally:
+    if jobs > 1:
+      pool.terminate()
+      pool.join()
+    if cache:
+      cache.flush()
+
+
 @Session.wraps
-def syncdb():
-  print('qu syncdb')
+def syncdb(jobs=1, batch_size=500, full=False, progress=sys.stdout):
+  """
+  Synchronizes the database with the files in the library root. Writes
+  the progress to the stream *progress*, one character per file (`.`
+  unchanged, `+` new, `!` updated, `?` unreadable). If *full* is True,
+  all files are checked even if `sync_skip_directories` is enabled.
+  Returns a #SyncReport of the run.
+  """
+
+  report = SyncReport()
+  out = Progress(progress)
+  out.write('qu syncdb\n')
 
   current_time = time.time()
-  new_tracks = 0
-  updated_tracks = 0
   session = Session.current()
+  catalogue = Catalogue(session)
+  committer = Committer(session, catalogue, config.sync_commit_files,
+    config.sync_commit_interval)
 
-  for root, dirs, files in os.walk(config.library_root):
-    for filename in files:
-      sys.stdout.flush()
-      filename = os.path.join(root, filename)
+  # Classify every file as new, changed or unchanged against an index
+  # of the tracks that is loaded once, rather than querying per file.
+  # Entries are removed from the index as their files are found, so
+  # whatever remains after the walk are the tracks that were deleted.
+  with report.phase('load_index'):
+    index = Track.load_index()
+    removed = []
 
-      # Check if the track is already in the database.
-      track = Track.get(filename, or_create=True)
-      if track.id:
-        # Track was already in the database. Did it change?
-        if os.path.getmtime(filename) <= track.last_update_time:
-          # We'll still update the tracks modification time to know
-          # that the file existed the last time we checked.
-          track.last_update_time = current_time
-          session.add(track)
-          print('.', end='')
+    # With `sync_skip_directories`, directories whose modification time
+    # and number of entries still match the recorded state are not
+    # looked into unless *full* is set. Note that changing a file
+    # in-place does not change the modification time of its parent
+    # directory.
+    skip_directories = config.sync_skip_directories and not full
+    directories = Directory.load_index()
+    skipped = set()
+    dir_states = []
+
+  # Maps the filenames that need their metadata (re-)read to the ID of
+  # their #Track (or None for new files) and their stat result. The
+  # metadata is only read after the walk, so that all database access
+  # happens on the main thread.
+  pending = {}
+
+  walk = pathutils.scandir_walk(config.library_root)
+  for dirname, stat, entry_count, files in report.iterate('walk', walk):
+    with report.phase('walk'):
+      path = get_dbpath(dirname)
+      state = (stat.st_mtime, entry_count)
+      record = directories.pop(path, None)
+      if skip_directories and record is not None and record[1:] == state:
+        skipped.add(path)
+        report.count('skipped_directories')
+        continue
+      if record is None or record[1:] != state:
+        dir_states.append({'id': record[0] if record else None,
+          'path': path, 'mtime': state[0], 'entry_count': state[1]})
+
+      for entry in files:
+        # Check if the track is already in the database. Did it change?
+        known = index.pop(get_dbpath(entry.path), None)
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue
+        if known is not None and stat.st_mtime <= known[1]:
+          out.write('.')
+          report.count('unchanged')
           continue  # nope
 
-      # Read the metadata and transfer the information to the track.
-      data = metadata.read_metadata(filename)
-      if not data:
-        print('?', end='')
+        pending[entry.path] = (known[0] if known is not None else None, stat)
+
+  # The tracks are built as transient objects and written with one
+  # upsert per batch, replacing all columns of existing tracks.
+  columns = [c.key for c in Track.__table__.columns if c.key != 'id']
+  results = read_metadata_all({k: v[1] for k, v in pending.items()}, jobs)
+  results = report.iterate('read_metadata', results)
+  for batch in chunks(results, min(batch_size, config.sync_commit_files)):
+    with report.phase('write'):
+      # Changed tracks may leave their current artist, album and genre.
+      ids = [pending[filename][0] for filename, data, _ in batch if data]
+      ids = [x for x in ids if x is not None]
+      if ids:
+        catalogue.forget(ids)
+
+      rows = []
+      for filename, data, seconds in batch:
+        track_id, stat = pending.pop(filename)
+        report.count('read')
+        report.add_file(get_dbpath(filename), seconds, data)
+
+        # Transfer the metadata information to the track. Tracks that
+        # we can no longer read metadata from are removed.
+        if not data:
+          if track_id is not None:
+            removed.append(track_id)
+          out.write('?')
+          report.count('unreadable')
+          continue
+
+        if track_id is not None:
+          out.write('!')
+          report.count('updated')
+        else:
+          out.write('+')
+          report.count('new')
+
+        track = Track(path=get_dbpath(filename))
+        track.update_metadata(data, stat, current_time)
+        catalogue.assign(track)
+        rows.append({key: getattr(track, key) for key in columns})
+
+      # Write the batch and release the objects from the session.
+      Track.bulk_upsert(rows, key='path', batch_size=batch_size)
+      session.expunge_all()
+      committer.tick(len(batch))
+
+  # Delete the tracks of all files that we haven't seen this round,
+  # except for those in directories that we skipped.
+  with report.phase('delete'):
+    for path, (id, mtime) in index.items():
+      if posixpath.dirname(path) not in skipped:
+        removed.append(id)
+    del index
+    for ids in chunks(removed, batch_size):
+      catalogue.forget(ids)
+      session.query(Track).filter(Track.id.in_(ids)).delete(
+        synchronize_session=False)
+      committer.tick(len(ids))
+    report.count('removed', len(removed))
+
+  with report.phase('finish'):
+    catalogue.refresh(batch_size)
+
+    # Record the state of the directories that are new or changed and
+    # forget about the ones that no longer exist.
+    session.bulk_update_mappings(Directory, [x for x in dir_states if x['id']])
+    session.bulk_insert_mappings(Directory, [
+      {k: v for k, v in x.items() if k != 'id'} for x in dir_states if not x['id']])
+    for ids in chunks([x[0] for x in directories.values()], batch_size):
+      session.query(Directory).filter(Directory.id.in_(ids)).delete(
+        synchronize_session=False)
+
+    session.commit()
+
+  out.finish('{} new tracks, {} updated, {} removed'.format(
+    report.counts['new'], report.counts['updated'], report.counts['removed']))
+  return report
+
+
+@Session.wraps
+def sync_paths(filenames, batch_size=50):
+  """
+  Synchronizes the tracks for the specified *filenames* with the database.
+  Every filename may point to a file or a directory that was created,
+  changed, moved or deleted. Directories are synchronized recursively.
+  Changes are committed every *batch_size* files so that each transaction
+  remains small.
+  """
+
+  session = Session.current()
+  catalogue = Catalogue(session)
+  current_time = time.time()
+  count = 0
+
+  for filename in sorted(set(filenames)):
+    path = get_dbpath(filename)
+    if path.startswith('../'):
+      continue
+
+    if os.path.isdir(filename):
+      files = []
+      for _, _, _, entries in pathutils.scandir_walk(filename):
+        files.extend(entry.path for entry in entries)
+    elif os.path.isfile(filename):
+      files = [filename]
+    else:
+      files = []
+
+    # Remove the tracks for all files that no longer exist.
+    present = set(map(get_dbpath, files))
+    removed = [id for id, track_path in session.query(Track.id, Track.path)
+      .filter(in_subtree(Track.path, path)) if track_path not in present]
+    for ids in chunks(removed, batch_size):
+      catalogue.forget(ids)
+      session.query(Track).filter(Track.id.in_(ids)).delete(
+        synchronize_session=False)
+      logger.info('removed %d track(s) under %s', len(ids), path)
+    if not files:
+      session.query(Directory).filter(in_subtree(Directory.path, path))\
+        .delete(synchronize_session=False)
+
+    for filename in files:
+      track = Track.get(filename, or_create=True)
+      try:
+        stat = os.stat(filename)
+      except OSError:
+        continue
+      if track.id and stat.st_mtime <= track.last_update_time:
         continue
 
-      for key, value in data.items():
-        if hasattr(track, key):
-          setattr(track, key, value)
+      data = metadata.read_metadata(filename, get_sync_fields(), stat)
+      if not data:
+        if track.id:
+          catalogue.forget([track.id])
+          session.delete(track)
+          logger.info('removed %s', track.path)
+        continue
 
-      if track.id:
-        print('!', end='')
-        updated_tracks += 1
-      else:
-        print('+', end='')
-        new_tracks += 1
-      track.has_cover = bool(data.get('cover'))
-      track.last_update_time = current_time
+      logger.info('%s %s', 'updated' if track.id else 'added', track.path)
+      track.update_metadata(data, stat, current_time)
+      catalogue.assign(track)
       session.add(track)
 
-  session.commit()
+      count += 1
+      if count % batch_size == 0:
+        catalogue.refresh()
+        session.commit()
+
+    catalogue.refresh()
+    session.commit()
+
+  cache = metadata.get_cache()
+  if cache:
+    cache.flush()
+
+
+def _read_audio_metadata(filename):
+  """
+  Worker function for #index_audio().
+  """
+
+  return filename, metadata.read_metadata(filename, {metadata.AUDIO}, use_cache=False)
+
+
+@Session.wraps
+def index_audio(jobs=1, batch_size=500, progress=sys.stdout):
+  """
+  Indexes the audio frames of all tracks that have no seek table yet,
+  which is the case if they were synchronized without the
+  `sync_audio_index` option. This reads every byte of the files, see
+  #metadata.AUDIO. Writes the progress to the stream *progress*, one
+  character per file (`+` indexed, `?` unreadable).
+  """
+
+  out = Progress(progress)
+  out.write('qu index-audio\n')
+  session = Session.current()
+  query = session.query(Track.id, Track.path).filter(Track.seek_table == None)
+  ids = {os.path.join(config.library_root, pathutils.from_dbpath(path)): id
+    for id, path in query}
 
-  # Query all tracks that haven't been updated this round and
-  # delete these entries.
-  deleted_tracks = session.query(Track).filter(
-    Track.last_update_time != current_time).delete()
+  if jobs <= 1:
+    results = map(_read_audio_metadata, ids)
+  else:
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap_unordered(_read_audio_metadata, ids, chunksize=16)
+  count = 0
+  try:
+    for batch in chunks(results, batch_size):
+      rows = []
+      for filename, data in batch:
+        if data and data.get('seek_table'):
+          row = {key: data.get(key) for key in AUDIO_COLUMNS}
+          row['id'] = ids[filename]
+          rows.append(row)
+          out.write('+')
+        else:
+          out.write('?')
+      session.bulk_update_mappings(Track, rows)
+      session.commit()
+      count += len(rows)
+  finally:
+    if jobs > 1:
+      pool.terminate()
+      pool.join()
 
-  print()
-  print('{} new tracks, {} updated, {} removed'.format(
-    new_tracks, updated_tracks, deleted_tracks))
+  out.finish('{} of {} tracks indexed'.format(count, len(ids)))
+
+
+@Session.wraps
+def build_thumbnails(jobs=1, progress=sys.stdout):
+  """
+  Renders the cover art thumbnails of all distinct covers in the
+  database, see #covers.build_all_thumbnails(). Writes the progress to
+  the stream *progress*, one character per cover (`+` thumbnails
+  created, `.` unchanged).
+  """
+
+  out = Progress(progress)
+  out.write('qu build-thumbnails\n')
+  session = Session.current()
+  digests = [x for x, in session.query(Track.cover_hash).distinct()
+    .filter(Track.cover_hash != None)]
+  count = 0
+  for created in covers.build_all_thumbnails(digests, jobs):
+    count += created
+    out.write('+' if created else '.')
+  out.finish('{} thumbnails created for {} covers'.format(count, len(digests)))
@@ -18,20 +18,211 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from ..metadata import MetaDataProvider, MimeData
+from ..metadata import (MetaDataProvider, MimeData, SEEK_INTERVAL,
+  pack_seek_table, ALL_FIELDS, TAGS, COVER, COVER_DATA, AUDIO)
+import hashlib
+import mmap
 import mutagen.mp3
 
+# Bitrates in kbit/s indexed by (MPEG-1, layer) and the bitrate index.
+# MPEG-2 and MPEG-2.5 share the same tables.
+BITRATES = {
+  (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+  (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+  (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+  (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+  (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+  (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates indexed by the version bits and the sample rate index.
+SAMPLE_RATES = {
+  0: [11025, 12000, 8000],   # MPEG-2.5
+  2: [22050, 24000, 16000],  # MPEG-2
+  3: [44100, 48000, 32000],  # MPEG-1
+}
+
+
+def parse_frame_header(b1, b2):
+  """
+  Parses the second and third byte of an MPEG audio frame header and
+  returns a tuple of the sample rate, the number of samples in the frame
+  and a function that computes the frame length from the padding bit.
+  Returns None if the header is invalid or uses the free bitrate.
+  """
+
+  version = (b1 >> 3) & 3
+  layer = 4 - ((b1 >> 1) & 3)
+  bitrate_index = b2 >> 4
+  rate_index = (b2 >> 2) & 3
+  if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+    return None
+  mpeg1 = version == 3
+  bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+  sample_rate = SAMPLE_RATES[version][rate_index]
+  if layer == 1:
+    samples = 384
+    length = (12 * bitrate // sample_rate) * 4
+    slot = 4
+  else:
+    samples = 1152 if (mpeg1 or layer == 2) else 576
+    length = samples // 8 * bitrate // sample_rate
+    slot = 1
+  return sample_rate, samples, length, slot
+
+
+def scan_frames(data, offset=0):
+  """
+  Walks over the MPEG audio frames in the buffer *data*, starting the
+  search for the first frame at *offset* (usually the end of the ID3v2
+  tag). Returns a dictionary with the `duration`, `bitrate`,
+  `audio_offset`, `audio_length` and the `seek_offsets` relative to the
+  `audio_offset`, one for every #SEEK_INTERVAL seconds. Returns None if
+  no frames were found.
+
+  A Xing/Info/VBRI header frame is included in the audio data but not
+  counted in the duration. Garbage between frames is skipped by searching
+  for the next frame sync.
+  """
+
+  size = len(data)
+  headers = {}
+  pos = offset
+  start = None
+  end = None
+  samples_total = 0
+  sample_rate = None
+  seek_offsets = []
+  next_mark = 0.0
+  first = True
+
+  while pos + 4 <= size:
+    if data[pos] != 0xff or data[pos + 1] & 0xe0 != 0xe0:
+      if start is not None and data[pos:pos + 3] in (b'TAG', b'APE'):
+        break
+      pos = data.find(b'\xff', pos + 1)
+      if pos < 0:
+        break
+      continue
+
+    key = (data[pos + 1], data[pos + 2] & 0xfc)
+    header = headers.get(key)
+    if header is None:
+      header = headers[key] = parse_frame_header(data[pos + 1], data[pos + 2])
+    if header is None:
+      pos += 1
+      continue
+    rate, samples, length, slot = header
+    if data[pos + 2] & 0x02:
+      length += slot
+
+    # Require the next frame to follow immediately when we're looking
+    # for the first frame, to avoid locking onto a false sync.
+    if start is None:
+      nxt = pos + length
+      if nxt + 2 <= size and (data[nxt] != 0xff or data[nxt + 1] & 0xe0 != 0xe0):
+        pos += 1
+        continue
+      start = pos
+      sample_rate = rate
+
+    if first:
+      first = False
+      frame = data[pos:pos + min(length, 64)]
+      if b'Xing' in frame or b'Info' in frame or b'VBRI' in frame:
+        pos += length
+        end = pos
+        continue
+
+    time = samples_total / sample_rate
+    while time >= next_mark:
+      seek_offsets.append(pos - start)
+      next_mark += SEEK_INTERVAL
+    samples_total += samples
+    pos += length
+    end = min(pos, size)
+
+  if start is None or not samples_total:
+    return None
+  duration = samples_total / sample_rate
+  return {
+    'duration': duration,
+    'bitrate': int((end - start) * 8 / duration),
+    'audio_offset': start,
+    'audio_length': end - start,
+    'seek_offsets': seek_offsets,
+  }
+
+
+def read_frame_info(filename, offset):
+  """
+  Maps the file into memory and runs #scan_frames() on it.
+  """
+
+  with open(filename, 'rb') as fp:
+    try:
+      data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      # Empty file.
+      return None
+    try:
+      return scan_frames(data, offset)
+    finally:
+      data.close()
+
 
 class MutagenMp3Provider(MetaDataProvider):
 
-  def read_metadata(self, filename):
+  # 2: estimated durations are returned with the tags.
+  version = 2
+
+  def read_metadata(self, filename, fields=None):
+    if fields is None:
+      fields = ALL_FIELDS
     try:
       tags = mutagen.mp3.Open(filename)
     except mutagen.MutagenError:
       return None
 
+    metadata = {'mime': 'audio/mp3'}
+    if TAGS in fields:
+      metadata.update(self.read_tags(tags))
+      if tags.tags is not None:
+        metadata['tag_size'] = tags.tags.size
+
+    # Load the covert art, it must be converted to a MimeData object.
+    # Unless the data is requested, only its size and hash are passed on.
+    covert_art = tags.get('APIC:')
+    if covert_art and COVER_DATA in fields:
+      metadata['cover'] = MimeData(covert_art.mime, covert_art.data)
+    elif covert_art and COVER in fields:
+      digest = hashlib.sha1(covert_art.data).hexdigest()
+      metadata['cover'] = MimeData(covert_art.mime, size=len(covert_art.data),
+        digest=digest)
+
+    # Index the audio frames for exact durations and time-based seeking.
+    if AUDIO in fields:
+      offset = tags.tags.size if tags.tags is not None else 0
+      try:
+        info = read_frame_info(filename, offset)
+      except OSError:
+        info = None
+      if info:
+        metadata['duration'] = info['duration']
+        metadata['bitrate'] = info['bitrate']
+        metadata['audio_offset'] = info['audio_offset']
+        metadata['audio_length'] = info['audio_length']
+        metadata['seek_table'] = pack_seek_table(info['seek_offsets'])
+    elif TAGS in fields and tags.info.length:
+      # Without the index, use the estimates that mutagen computes from
+      # the Xing header or the first frame.
+      metadata['duration'] = tags.info.length
+      metadata['bitrate'] = tags.info.bitrate
+
+    return metadata
+
+  def read_tags(self, tags):
     metadata = {
-      'mime': 'audio/mp3',
       'title': tags.get('TIT2'),
       'artist': tags.get('TPE1'),
       'album': tags.get('TALB'),
@@ -54,14 +245,7 @@ class MutagenMp3Provider(MetaDataProvider):
     # Filter out empty metadata and convert all tags to strings.
     metadata = filter(lambda x: bool(x[1]), metadata.items())
     metadata = map(lambda x: (x[0], str(x[1])), metadata)
-    metadata = dict(metadata)
-
-    # Load the covert art, it must be converted to a MimeData object.
-    covert_art = tags.get('APIC:')
-    if covert_art:
-      metadata['cover'] = MimeData(covert_art.mime, covert_art.data)
-
-    return metadata
+    return dict(metadata)
 
 
 def install_metadata_provider(register_provider):
@@ -18,10 +18,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from . import config
+from . import config, metrics
 from .pathutils import getsuffix
+import atexit
 import os
+import hashlib
 import importlib
+import struct
+import time
+
+#: Time in seconds between two entries of a seek table.
+SEEK_INTERVAL = 1.0
+
+#: Field groups that can be requested from #MetaDataProvider.read_metadata().
+#: `TAGS` are the text tags, `COVER` is the cover art without its data
+#: (only mime type, size and digest), `COVER_DATA` is the cover art with
+#: its data and `AUDIO` is information about the audio stream, which may
+#: require reading the whole file.
+TAGS = 'tags'
+COVER = 'cover'
+COVER_DATA = 'cover_data'
+AUDIO = 'audio'
+
+#: The field groups that are read if none are specified.
+ALL_FIELDS = frozenset([TAGS, COVER_DATA, AUDIO])
 
 
 class MetaDataProvider(object):
@@ -46,14 +66,29 @@ class MetaDataProvider(object):
   * `cover` - #MimeData object for the album cover art
   * `codec` - file codec information
   * `encoded_by` - file encoder information
+  * `duration` - playback duration in seconds, exact with `AUDIO`
+  * `bitrate` - average bitrate in bits per second, exact with `AUDIO`
+  * `audio_offset` - byte offset of the first audio frame in the file
+  * `audio_length` - number of bytes of audio frames from `audio_offset`
+  * `seek_table` - seek table created with #pack_seek_table()
+  * `tag_size` - number of bytes of tags that were read from the file
+
+  The *version* must be increased when the provider changes what it
+  returns, which invalidates the results in the #MetadataCache.
   """
 
-  def read_metadata(self, filename):
+  version = 1
+
+  def read_metadata(self, filename, fields=None):
     """
     Called to read metadata from the specified #filename. The
     file is garuanteed to exist and ends with the suffix that
     the provider was registered for.
 
+    :param fields: A set of the field groups to read (#TAGS, #COVER,
+      #COVER_DATA and #AUDIO), defaults to #ALL_FIELDS. Providers may
+      return more fields than requested, but should skip expensive work
+      for fields that are not. The `mime` is always returned.
     :return: A #dict mapping the metadata. Common metadata
       keys are listed in the docstring of #MetaDataProvider.
       Keys are case-sensitive.
@@ -64,19 +99,59 @@ class MetaDataProvider(object):
 
 class MimeData(object):
   """
-  Represents binary data accompanied by a mime-type.
+  Represents binary data accompanied by a mime-type. The *data* may be
+  omitted if only its *size* and SHA-1 hex *digest* are needed, which
+  are otherwise computed from the *data*.
   """
 
-  def __init__(self, mime, data):
+  def __init__(self, mime, data=None, size=None, digest=None):
     self.mime = mime
     self.data = data
+    self.size = len(data) if size is None else size
+    self.digest = hashlib.sha1(data).hexdigest() if digest is None else digest
 
   def __repr__(self):
-    size = len(self.data)
-    return 'MimeData(mime={!r}, len(data)={})'.format(self.mime, size)
+    return 'MimeData(mime={!r}, size={}, digest={!r})'.format(
+      self.mime, self.size, self.digest)
+
+
+def pack_seek_table(offsets):
+  """
+  Packs a list of byte *offsets* into a compact binary seek table. The
+  offsets must be relative to the `audio_offset` of the file and sorted,
+  the offset at index *i* being the start of the first frame that starts
+  at or after *i* * #SEEK_INTERVAL seconds. The offsets are stored as
+  16-bit deltas if possible, 32-bit otherwise.
+  """
+
+  deltas = [b - a for a, b in zip([0] + offsets, offsets)]
+  width = 2 if all(x <= 0xffff for x in deltas) else 4
+  fmt = '<{}{}'.format(len(deltas), 'H' if width == 2 else 'I')
+  return bytes([width]) + struct.pack(fmt, *deltas)
+
+
+def seek_offset(seek_table, seconds):
+  """
+  Returns the byte offset relative to the `audio_offset` of the frame at
+  which playback should start to begin at *seconds* into the track, and
+  the time at which that frame starts. Returns None if there is no such
+  entry in the packed *seek_table*.
+  """
+
+  if not seek_table or seconds < 0:
+    return None
+  width = seek_table[0]
+  index = int(seconds // SEEK_INTERVAL)
+  count = (len(seek_table) - 1) // width
+  if index >= count:
+    return None
+  fmt = '<{}{}'.format(index + 1, 'H' if width == 2 else 'I')
+  deltas = struct.unpack_from(fmt, seek_table, 1)
+  return sum(deltas), index * SEEK_INTERVAL
 
 
 providers = {}
+_cache = None
 
 
 def load_extension(*extensions):
@@ -99,15 +174,84 @@ def register_provider(provider, suffix):
   providers[suffix] = provider
 
 
-def read_metadata(filename):
+def get_provider(suffix):
+  """
+  Returns the #MetaDataProvider for *suffix*, or None if the suffix is
+  not supported. The extension module that is configured for the suffix
+  in `metadata_providers` is loaded on the first call.
+  """
+
+  provider = providers.get(suffix)
+  if provider is None and suffix in config.metadata_providers:
+    load_extension(config.metadata_providers[suffix])
+    provider = providers.get(suffix)
+  return provider
+
+
+def get_cache():
+  """
+  Returns the #MetadataCache configured with the `metadata_cache` and
+  `metadata_cache_size` configuration values, or None if the cache is
+  disabled. The cache is closed when the process exits.
+  """
+
+  global _cache
+  if _cache is None and config.metadata_cache:
+    from .metadata_cache import MetadataCache
+    _cache = MetadataCache(config.metadata_cache, config.metadata_cache_size)
+    atexit.register(_cache.close)
+  return _cache
+
+
+def get_cache_key(filename, fields=None, stat=None):
+  """
+  Returns the key of the #MetadataCache for reading the *fields* of
+  *filename*, or None if the result can not be cached. The *stat* of
+  the file is read if it is not specified. The cover art data is never
+  cached.
+  """
+
+  provider = get_provider(getsuffix(filename))
+  if provider is None:
+    return None
+  fields = ALL_FIELDS if fields is None else fields
+  if COVER_DATA in fields:
+    return None
+  if stat is None:
+    stat = os.stat(filename)
+  from .metadata_cache import MetadataCache
+  return MetadataCache.make_key(provider, fields, stat)
+
+
+def read_metadata(filename, fields=None, stat=None, use_cache=True):
   """
   Selects the appropriate #MetaDataProvider for the specified #filename
   and returns the metadata dictionary it extracts, or returns None if
-  no metadata could be extracted.
+  no metadata could be extracted. See #MetaDataProvider.read_metadata()
+  for the *fields*.
+
+  If *use_cache* is True and the #MetadataCache is enabled, the result
+  is read from and stored in the cache. The *stat* of the file may be
+  passed if it is already known. The cache must not be used by forked
+  worker processes.
   """
 
-  suffix = getsuffix(filename)
-  if suffix not in providers:
+  provider = get_provider(getsuffix(filename))
+  if provider is None:
     return None
 
-  return providers[suffix].read_metadata(filename)
+  cache = get_cache() if use_cache else None
+  key = get_cache_key(filename, fields, stat) if cache else None
+  if key is not None:
+    from .metadata_cache import MISSING
+    data = cache.get(key)
+    if data is not MISSING:
+      return data
+
+  start = time.perf_counter()
+  data = provider.read_metadata(filename, fields)
+  metrics.METADATA_READS.observe(time.perf_counter() - start,
+    (type(provider).__name__,))
+  if key is not None:
+    cache.put(key, data)
+  return data
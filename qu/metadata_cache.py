@@ -0,0 +1,161 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import hashlib
+import logging
+import pickle
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+#: Returned by #MetadataCache.get() if there is no entry for a key.
+MISSING = object()
+
+
+class MetadataCache(object):
+  """
+  A size-bounded cache of the results of #metadata.read_metadata() in
+  an SQLite database *filename*. Entries are keyed by the identity of
+  the file (device, inode, size and modification time), the metadata
+  provider and its version and the requested fields, see #make_key().
+  When the total size of the entries exceeds *max_size* bytes, the
+  least recently used entries are evicted.
+
+  New entries are committed at least every *commit_interval* seconds
+  and with #flush(), so that processes that share the cache (like
+  --syncdb and --watch) only hold its write lock briefly. They wait up
+  to *timeout* seconds for the lock. If it can not be acquired, the
+  uncommitted entries are dropped, as they can be read again.
+  """
+
+  def __init__(self, filename, max_size, commit_interval=2.0, timeout=30.0):
+    self.filename = filename
+    self.max_size = max_size
+    self.commit_interval = commit_interval
+    self.last_commit = time.time()
+    self.conn = sqlite3.connect(filename, timeout=timeout)
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.execute('CREATE TABLE IF NOT EXISTS metadata (key BLOB PRIMARY KEY, '
+      'value BLOB NOT NULL, size INTEGER NOT NULL, atime INTEGER NOT NULL)')
+    self.conn.execute('CREATE INDEX IF NOT EXISTS ix_atime ON metadata (atime)')
+    self.total_size = self.conn.execute(
+      'SELECT COALESCE(SUM(size), 0) FROM metadata').fetchone()[0]
+    self.touched = set()
+
+  @staticmethod
+  def make_key(provider, fields, stat):
+    """
+    Returns the cache key for the metadata *fields* (a set of field
+    groups) read by *provider* from a file with the #os.stat_result
+    *stat*, or None if the file can not be identified reliably.
+    """
+
+    if not stat.st_ino:
+      return None
+    cls = type(provider)
+    key = '{}:{}:{}:{}:{}.{}:{}:{}'.format(stat.st_dev, stat.st_ino,
+      stat.st_size, stat.st_mtime_ns, cls.__module__, cls.__qualname__,
+      provider.version, ','.join(sorted(fields)))
+    return hashlib.sha1(key.encode('utf8')).digest()
+
+  def get(self, key):
+    """
+    Returns the metadata dictionary (or None if the file had no readable
+    metadata) for the *key*, or #MISSING if it isn't cached.
+    """
+
+    row = self.conn.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      return MISSING
+    self.touched.add(key)
+    return pickle.loads(row[0])
+
+  def put(self, key, data):
+    """
+    Stores the metadata dictionary *data* for the *key*.
+    """
+
+    value = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    try:
+      row = self.conn.execute('SELECT size FROM metadata WHERE key = ?', (key,)).fetchone()
+      self.conn.execute('INSERT OR REPLACE INTO metadata (key, value, size, atime) '
+        'VALUES (?, ?, ?, ?)', (key, value, len(value), int(time.time())))
+    except sqlite3.OperationalError as exc:
+      self.rollback(exc)
+      return
+    if row is not None:
+      self.total_size -= row[0]
+    self.total_size += len(value)
+    self.touched.discard(key)
+    if time.time() - self.last_commit >= self.commit_interval:
+      self.commit()
+
+  def commit(self):
+    try:
+      self.conn.commit()
+    except sqlite3.OperationalError as exc:
+      self.rollback(exc)
+    self.last_commit = time.time()
+
+  def rollback(self, exc):
+    logger.warning('discarding changes to the metadata cache: %s', exc)
+    self.conn.rollback()
+    self.total_size = self.conn.execute(
+      'SELECT COALESCE(SUM(size), 0) FROM metadata').fetchone()[0]
+
+  def evict(self):
+    """
+    Deletes the least recently used entries until the cache uses at most
+    90% of its maximum size.
+    """
+
+    if self.total_size <= self.max_size:
+      return
+    excess = self.total_size - self.max_size * 9 // 10
+    keys = []
+    for key, size in self.conn.execute('SELECT key, size FROM metadata ORDER BY atime'):
+      if excess <= 0:
+        break
+      keys.append((key,))
+      excess -= size
+      self.total_size -= size
+    self.conn.executemany('DELETE FROM metadata WHERE key = ?', keys)
+
+  def flush(self):
+    """
+    Records the access times of the entries that were read, evicts
+    entries if the cache is too large and commits the changes.
+    """
+
+    now = int(time.time())
+    try:
+      self.conn.executemany('UPDATE metadata SET atime = ? WHERE key = ?',
+        ((now, key) for key in self.touched))
+      self.evict()
+    except sqlite3.OperationalError as exc:
+      self.rollback(exc)
+    self.touched.clear()
+    self.commit()
+
+  def close(self):
+    self.flush()
+    self.conn.close()
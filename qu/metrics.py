@@ -0,0 +1,193 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import bisect
+import threading
+
+#: All metrics in the order they were created.
+registry = []
+
+#: Default buckets of #Histogram in seconds.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+  """
+  Base class for metrics that are exported in the Prometheus text
+  format by #render(). The values are kept per tuple of label values,
+  matching the *labelnames*. Updates take a lock, as they are cheap
+  enough not to need anything more elaborate.
+  """
+
+  type = None
+
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.values = {}
+    self.lock = threading.Lock()
+    registry.append(self)
+
+  def samples(self):
+    """
+    Yields tuples of the sample name suffix, a tuple of label name/value
+    pairs and the value of every sample of the metric.
+    """
+
+    with self.lock:
+      values = dict(self.values)
+    for labels, value in sorted(values.items()):
+      yield '', tuple(zip(self.labelnames, labels)), value
+
+
+class Counter(Metric):
+  type = 'counter'
+
+  def inc(self, amount=1, labels=()):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+  type = 'gauge'
+
+  def dec(self, amount=1, labels=()):
+    self.inc(-amount, labels)
+
+  def set(self, value, labels=()):
+    with self.lock:
+      self.values[labels] = value
+
+
+class Histogram(Metric):
+  type = 'histogram'
+
+  def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    super().__init__(name, help, labelnames)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, labels=()):
+    index = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      counts = self.values.get(labels)
+      if counts is None:
+        counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+      counts[index] += 1
+      counts[-1] += value
+
+  def totals(self, labels=()):
+    """
+    Returns the number and the sum of the observed values for *labels*.
+    """
+
+    with self.lock:
+      counts = self.values.get(labels)
+      if counts is None:
+        return 0, 0.0
+      return sum(counts[:-1]), counts[-1]
+
+  def samples(self):
+    with self.lock:
+      values = {k: list(v) for k, v in self.values.items()}
+    for labels, counts in sorted(values.items()):
+      labels = tuple(zip(self.labelnames, labels))
+      total = 0
+      for bound, count in zip(self.buckets + (float('inf'),), counts):
+        total += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        yield '_bucket', labels + (('le', le),), total
+      yield '_sum', labels, counts[-1]
+      yield '_count', labels, total
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render():
+  """
+  Returns all metrics in the #registry in the Prometheus text format.
+  """
+
+  lines = []
+  for metric in registry:
+    lines.append('# HELP {} {}'.format(metric.name, metric.help))
+    lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+    for suffix, labels, value in metric.samples():
+      if labels:
+        labels = '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+      else:
+        labels = ''
+      lines.append('{}{}{} {}'.format(metric.name, suffix, labels, value))
+  return '\n'.join(lines) + '\n'
+
+
+# Per-thread statistics of the request that is currently being handled.
+_request = threading.local()
+
+
+def start_request():
+  """
+  Resets the SQL statistics of the current thread's request.
+  """
+
+  _request.sql_count = 0
+  _request.sql_time = 0.0
+
+
+def request_sql_stats():
+  """
+  Returns the number of SQL queries and their total duration in the
+  current thread's request since #start_request().
+  """
+
+  return getattr(_request, 'sql_count', 0), getattr(_request, 'sql_time', 0.0)
+
+
+def record_query(duration):
+  """
+  Records an SQL query that took *duration* seconds.
+  """
+
+  SQL_QUERIES.observe(duration)
+  if hasattr(_request, 'sql_count'):
+    _request.sql_count += 1
+    _request.sql_time += duration
+
+
+HTTP_REQUESTS = Counter('qu_http_requests_total',
+  'Number of HTTP requests by view and status code.', ['view', 'status'])
+HTTP_REQUEST_DURATION = Histogram('qu_http_request_duration_seconds',
+  'Time until the response of a view is ready, without streaming the body.', ['view'])
+REQUEST_SQL_QUERIES = Histogram('qu_http_request_sql_queries',
+  'Number of SQL queries per HTTP request.', ['view'],
+  buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+REQUEST_SQL_DURATION = Histogram('qu_http_request_sql_duration_seconds',
+  'Total time spent in SQL queries per HTTP request.', ['view'])
+ACTIVE_STREAMS = Gauge('qu_active_streams',
+  'Number of audio streams that are currently being sent.')
+STREAM_BYTES = Counter('qu_stream_bytes_total',
+  'Number of bytes of audio files sent by /stream.')
+SQL_QUERIES = Histogram('qu_sql_query_duration_seconds',
+  'Duration of SQL queries.')
+METADATA_READS = Histogram('qu_metadata_read_duration_seconds',
+  'Duration of metadata provider calls by provider.', ['provider'])
@@ -22,4 +22,4 @@ from .op import *
 from .columns import *
 from .entity import new_entity
 from .session import Session
-from sqlalchemy import create_engine as new_engine
+from sqlalchemy import create_engine as new_engine, event, exc, inspect
@@ -19,7 +19,7 @@
 # THE SOFTWARE.
 
 import pickle
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, Index
 from sqlalchemy.types import (Boolean, SmallInteger, Integer, BigInteger,
   Enum, Text, String, Unicode, Time, DateTime, Date, Float, Numeric, LargeBinary)
 
@@ -32,12 +32,12 @@ def smallint(**kwargs):
   return Column(SmallInt, **kwargs)
 
 
-def int(**kwargs):
-  return Column(Integer, **kwargs)
+def int(*args, **kwargs):
+  return Column(Integer, *args, **kwargs)
 
 
-def bigint(**kwargs):
-  return Column(BigInteger, **kwargs)
+def bigint(*args, **kwargs):
+  return Column(BigInteger, *args, **kwargs)
 
 
 def enum(*enums, **kwargs):
@@ -101,3 +101,37 @@ def python(protocol=pickle.HIGHEST_PROTOCOL, pickler=None, comparator=None, **kw
 
 def foreign_key(*args, **kwargs):
   return ForeignKey(*args, **kwargs)
+
+
+class IndexDeclaration(object):
+  """
+  Declaration of an index in the body of an entity class, see #index().
+  """
+
+  def __init__(self, columns, unique, include, name, kwargs):
+    self.columns = columns
+    self.unique = unique
+    self.include = include
+    self.name = name
+    self.kwargs = kwargs
+
+  def create(self, name):
+    columns = list(self.columns) + list(self.include)
+    return Index(self.name or name, *columns, unique=self.unique, **self.kwargs)
+
+
+def index(*columns, unique=False, include=(), name=None, **kwargs):
+  """
+  Declares a (composite) index over the specified *columns* of an
+  entity. Columns may also be SQL expressions over the columns of the
+  entity. The columns in *include* are appended to the index key so
+  that the index covers queries that select them, which works the same
+  on all databases. The index name defaults to `ix_<table>_<attribute>`.
+
+      class Track(Entity):
+        artist = orm.unicode()
+        album = orm.unicode()
+        ix_artist_album = orm.index(artist, album)
+  """
+
+  return IndexDeclaration(columns, unique, include, name, kwargs)
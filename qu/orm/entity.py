@@ -18,9 +18,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from sqlalchemy import event
+from sqlalchemy import event, bindparam, func, select, text, tuple_
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
+from .columns import IndexDeclaration
+from .session import Session
+import itertools
 
 
 class EntityMeta(DeclarativeMeta):
@@ -40,6 +43,8 @@ class EntityMeta(DeclarativeMeta):
   Additionally, this metaclass will take care of the following:
 
   * set `__tablename__` if it is not defined
+  * convert indexes declared with #columns.index() to the
+    `__table_args__`
   """
 
   def __new__(cls, name, bases, data):
@@ -72,8 +77,178 @@ class EntityMeta(DeclarativeMeta):
       if '__tablename__' not in data:
         data['__tablename__'] = name.lower()
 
+      # Indexes declared with columns.index().
+      indexes = []
+      for key, value in list(data.items()):
+        if isinstance(value, IndexDeclaration):
+          del data[key]
+          if key.startswith('ix_'):
+            key = key[3:]
+          indexes.append(value.create('ix_{}_{}'.format(data['__tablename__'], key)))
+      if indexes:
+        args = data.get('__table_args__', ())
+        if isinstance(args, dict):
+          args = (args,)
+        if args and isinstance(args[-1], dict):
+          args = tuple(args[:-1]) + tuple(indexes) + (args[-1],)
+        else:
+          args = tuple(args) + tuple(indexes)
+        data['__table_args__'] = args
+
     return super().__new__(cls, name, bases, data)
 
 
+class EntityBase(object):
+  """
+  Base class for the declarative base created with #new_entity().
+  """
+
+  # Maximum number of bound parameters in a single statement. SQLite
+  # before 3.32 allows no more than 999.
+  max_parameters = 999
+
+  @classmethod
+  def bulk_upsert(cls, rows, key, batch_size=500, hooks=False, session=None):
+    """
+    Inserts the *rows* (dictionaries that map column names to values)
+    into the entity's table, or updates the columns of the rows that
+    conflict with an existing row in the unique column(s) *key*. The
+    rows are written with one multi-row `INSERT ... ON CONFLICT DO
+    UPDATE` statement (`ON DUPLICATE KEY UPDATE` on MySQL) per batch of
+    up to *batch_size* rows, bypassing the unit of work of the *session*
+    (defaults to the current #Session).
+
+    If *hooks* is True, an instance of the entity is created for every
+    row so that the `validate_X()` callbacks and `save()` run before the
+    row is written, otherwise they are skipped.
+
+    If multiple rows in a batch have the same key, only the last one is
+    written.
+
+    :return: A tuple of the number of inserted and updated rows. Rows
+      that are updated are determined before writing each batch.
+    """
+
+    if session is None:
+      session = Session.current()
+    key = (key,) if isinstance(key, str) else tuple(key)
+    table = cls.__table__
+    dialect = session.get_bind().dialect
+    quote = dialect.identifier_preparer.quote
+
+    if hooks:
+      rows = (cls._run_hooks(row) for row in rows)
+
+    inserted = updated = 0
+    for batch in _chunks(rows, batch_size):
+      # A statement can't affect the same row twice, thus only the last
+      # of the rows with the same key in a batch is written.
+      unique = {}
+      for row in batch:
+        unique[tuple(row[name] for name in key)] = row
+
+      # Rows with different columns can't share a statement.
+      groups = {}
+      for row in unique.values():
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+
+      for names, group in groups.items():
+        columns = [table.c[name] for name in names]
+        per_statement = max(1, min(batch_size, cls.max_parameters // len(columns)))
+        for rows_chunk in _chunks(group, per_statement):
+          existing = cls._count_existing(session, key, rows_chunk)
+          updated += existing
+          inserted += len(rows_chunk) - existing
+          statement, param_names = cls._upsert_statement(
+            dialect, quote, key, columns, len(rows_chunk))
+          params = {}
+          for row, row_names in zip(rows_chunk, param_names):
+            for name, param_name in zip(names, row_names):
+              params[param_name] = row[name]
+          session.connection().execute(statement, params)
+
+    return inserted, updated
+
+  @classmethod
+  def _run_hooks(cls, row):
+    obj = cls(**row)
+    if hasattr(obj, 'save'):
+      obj.save()
+    result = {}
+    for column in cls.__table__.columns:
+      value = getattr(obj, column.key)
+      if column.key in row or value is not None:
+        result[column.key] = value
+    return result
+
+  @classmethod
+  def _count_existing(cls, session, key, rows):
+    columns = [cls.__table__.c[name] for name in key]
+    if len(key) == 1:
+      keys = list(set(row[key[0]] for row in rows))
+      column = columns[0]
+    else:
+      keys = list(set(tuple(row[name] for name in key) for row in rows))
+      column = tuple_(*columns)
+    query = select([func.count()]).select_from(cls.__table__)\
+      .where(column.in_(bindparam('keys', expanding=True)))
+    return session.connection().execute(query, keys=keys).scalar()
+
+  @classmethod
+  def _upsert_statement(cls, dialect, quote, key, columns, count):
+    """
+    Returns the compiled upsert statement for *count* rows of the
+    *columns* and a list of the parameter names for every row. The
+    statements are cached, as compiling them takes longer than running
+    them for large batches.
+    """
+
+    cache_key = (cls, dialect.name, key, tuple(c.key for c in columns), count)
+    result = _upsert_cache.get(cache_key)
+    if result is not None:
+      return result
+
+    names = [quote(column.name) for column in columns]
+    params = []
+    param_names = []
+    values = []
+    for index in range(count):
+      row_names = ['{}_{}'.format(column.key, index) for column in columns]
+      params.extend(bindparam(n, type_=c.type) for n, c in zip(row_names, columns))
+      values.append('(' + ', '.join(':' + n for n in row_names) + ')')
+      param_names.append(row_names)
+
+    sql = 'INSERT INTO {} ({}) VALUES {}'.format(
+      quote(cls.__table__.name), ', '.join(names), ', '.join(values))
+    update = [name for column, name in zip(columns, names) if column.key not in key]
+    if dialect.name in ('sqlite', 'postgresql'):
+      sql += ' ON CONFLICT ({})'.format(', '.join(quote(x) for x in key))
+      if update:
+        sql += ' DO UPDATE SET ' + ', '.join('{0} = excluded.{0}'.format(x) for x in update)
+      else:
+        sql += ' DO NOTHING'
+    elif dialect.name == 'mysql':
+      update = update or [quote(key[0])]
+      sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join('{0} = VALUES({0})'.format(x) for x in update)
+    else:
+      raise NotImplementedError('bulk_upsert() is not supported on {}'.format(dialect.name))
+
+    compiled = text(sql).bindparams(*params).compile(dialect=dialect)
+    _upsert_cache[cache_key] = compiled, param_names
+    return compiled, param_names
+
+
+_upsert_cache = {}
+
+
+def _chunks(iterable, size):
+  iterable = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterable, size))
+    if not chunk:
+      break
+    yield chunk
+
+
 def new_entity(name='Entity', metaclass=EntityMeta):
-  return declarative_base(name=name, metaclass=metaclass)
+  return declarative_base(name=name, metaclass=metaclass, cls=EntityBase)
@@ -18,4 +18,4 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from sqlalchemy import asc, desc
+from sqlalchemy import asc, desc, and_, or_, not_, true, false, func, tuple_, select, exists
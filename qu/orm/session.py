@@ -60,12 +60,13 @@ class Session(session.Session):
     Creates a new subclass of the specified #cls which automatically
     constructs using the specified arguments. This is different from
     the #sqlalchemy.orm.sessionmaker() function in that it returns an
-    actual class object that inherits from #cls.
+    actual class object that inherits from #cls. If *bind* is a function,
+    it is called to get the bind every time a session is created.
     """
 
     class Session(cls):
       def __init__(self):
-        super().__init__(bind=bind, *args, **kwargs)
+        super().__init__(bind=bind() if callable(bind) else bind, *args, **kwargs)
     return Session
 
   @staticmethod
@@ -46,3 +46,38 @@ def from_dbpath(path):
   """
 
   return path.replace('/', os.sep)
+
+
+def scandir_walk(top):
+  """
+  Walks the directory tree under *top* like #os.walk(), but uses
+  #os.scandir() so that file type information comes from the directory
+  listing. Yields a tuple of `(dirname, stat, entry_count, files)` for
+  every directory, where *stat* is the stat result of the directory
+  taken before it was listed, *entry_count* is the number of entries
+  in the directory and *files* is a list of #os.DirEntry objects for
+  the files in it. Symbolic links to directories are not followed.
+  """
+
+  stack = [top]
+  while stack:
+    dirname = stack.pop()
+    try:
+      stat = os.stat(dirname)
+      with os.scandir(dirname) as it:
+        entries = list(it)
+    except OSError:
+      continue
+
+    files = []
+    for entry in entries:
+      try:
+        is_dir = entry.is_dir()
+      except OSError:
+        is_dir = False
+      if not is_dir:
+        files.append(entry)
+      elif not entry.is_symlink():
+        stack.append(entry.path)
+
+    yield dirname, stat, len(entries), files
@@ -0,0 +1,155 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from . import metrics
+from .pathutils import getsuffix
+import collections
+import contextlib
+import heapq
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+def _children_cpu_time():
+  if resource is None:
+    return 0.0
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime
+
+
+class SyncReport(object):
+  """
+  Collects where the time of a #database.syncdb() run goes: the wall
+  and CPU time of its phases, the time spent reading the metadata of
+  files per suffix and the *slowest* files, the bytes of tags read and
+  the number of SQL statements. CPU time of worker processes is only
+  accounted after they exited.
+  """
+
+  def __init__(self, slowest=10):
+    self.start_time = time.perf_counter()
+    self.start_cpu = time.process_time()
+    self.start_children_cpu = _children_cpu_time()
+    self.start_sql = metrics.SQL_QUERIES.totals()
+    self.phases = collections.OrderedDict()
+    self.counts = collections.Counter()
+    self.suffixes = {}
+    self.slowest_count = slowest
+    self.slowest = []
+    self.tag_bytes = 0
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    """
+    Context manager that adds the wall and CPU time of its body to the
+    phase *name*. Phases may be entered multiple times.
+    """
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+      yield
+    finally:
+      totals = self.phases.setdefault(name, [0.0, 0.0])
+      totals[0] += time.perf_counter() - wall
+      totals[1] += time.process_time() - cpu
+
+  def iterate(self, name, iterable):
+    """
+    Yields the items of *iterable*, adding the time spent waiting for
+    them to the phase *name*.
+    """
+
+    iterator = iter(iterable)
+    while True:
+      with self.phase(name):
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+      yield item
+
+  def count(self, key, n=1):
+    self.counts[key] += n
+
+  def add_file(self, filename, seconds, data):
+    """
+    Records that the metadata of *filename* was read in *seconds* (None
+    if it came from the cache).
+    """
+
+    if seconds is None:
+      self.count('cache_hits')
+      return
+    totals = self.suffixes.setdefault(getsuffix(filename), [0, 0.0])
+    totals[0] += 1
+    totals[1] += seconds
+    if data:
+      self.tag_bytes += data.get('tag_size', 0)
+    item = (seconds, filename)
+    if len(self.slowest) < self.slowest_count:
+      heapq.heappush(self.slowest, item)
+    elif item > self.slowest[0]:
+      heapq.heapreplace(self.slowest, item)
+
+  def to_dict(self):
+    wall = time.perf_counter() - self.start_time
+    sql_count, sql_time = metrics.SQL_QUERIES.totals()
+    files = self.counts['unchanged'] + self.counts['read']
+    return {
+      'wall_time': wall,
+      'cpu_time': time.process_time() - self.start_cpu,
+      'worker_cpu_time': _children_cpu_time() - self.start_children_cpu,
+      'files': dict(self.counts),
+      'files_per_second': files / wall if wall else None,
+      'phases': {k: {'wall_time': v[0], 'cpu_time': v[1]} for k, v in self.phases.items()},
+      'suffixes': {k: {'files': v[0], 'read_time': v[1]} for k, v in sorted(self.suffixes.items())},
+      'slowest_files': [{'path': f, 'read_time': s} for s, f in sorted(self.slowest, reverse=True)],
+      'tag_bytes': self.tag_bytes,
+      'db_statements': sql_count - self.start_sql[0],
+      'db_time': sql_time - self.start_sql[1],
+    }
+
+
+class Progress(object):
+  """
+  Writes progress characters to *stream*, but flushes it at most every
+  *interval* seconds.
+  """
+
+  def __init__(self, stream, interval=0.5):
+    self.stream = stream
+    self.interval = interval
+    self.last_flush = time.perf_counter()
+
+  def write(self, text):
+    self.stream.write(text)
+    now = time.perf_counter()
+    if now - self.last_flush >= self.interval:
+      self.stream.flush()
+      self.last_flush = now
+
+  def finish(self, text=''):
+    self.stream.write('\n' + text + ('\n' if text else ''))
+    self.stream.flush()
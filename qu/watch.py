@@ -0,0 +1,246 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from . import config, pathutils
+import ctypes, ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class InotifyWatcher(object):
+  """
+  Watches a directory tree with the Linux inotify API through #ctypes.
+  Iterating over the watcher yields sets of the paths of files and
+  directories that were created, modified, moved or deleted. Events
+  are collected until no new events arrived for *delay* seconds.
+  """
+
+  IN_MODIFY = 0x00000002
+  IN_ATTRIB = 0x00000004
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_DELETE_SELF = 0x00000400
+  IN_MOVE_SELF = 0x00000800
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_ONLYDIR = 0x01000000
+  IN_ISDIR = 0x40000000
+  IN_CLOEXEC = 0o2000000
+
+  MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+  _event = struct.Struct('iIII')
+  _libc = None
+
+  def __init__(self, root, delay=1.0):
+    libc = self.get_libc()
+    if libc is None:
+      raise OSError(errno.ENOSYS, 'inotify is not available')
+    self.root = root
+    self.delay = delay
+    self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+    self.watches = {}
+    self.add_tree(root)
+
+  @classmethod
+  def get_libc(cls):
+    """
+    Returns the C library with the inotify functions, or None if they
+    are not available on this platform.
+    """
+
+    if cls._libc is None and sys.platform.startswith('linux'):
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      if hasattr(libc, 'inotify_init1'):
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        cls._libc = libc
+    return cls._libc
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def add_watch(self, dirname):
+    wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirname), self.MASK)
+    if wd < 0:
+      code = ctypes.get_errno()
+      if code == errno.ENOSPC:
+        logger.error('inotify watch limit reached, see '
+          '/proc/sys/fs/inotify/max_user_watches')
+      raise OSError(code, os.strerror(code), dirname)
+    self.watches[wd] = dirname
+
+  def remove_tree(self, top):
+    for wd, dirname in list(self.watches.items()):
+      if dirname == top or dirname.startswith(top + os.sep):
+        self._libc.inotify_rm_watch(self.fd, wd)
+        del self.watches[wd]
+
+  def add_tree(self, top):
+    for dirname, _, _, _ in pathutils.scandir_walk(top):
+      try:
+        self.add_watch(dirname)
+      except OSError as exc:
+        if exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+          raise
+
+  def read_events(self):
+    """
+    Reads the pending events from the inotify file descriptor and
+    returns a set of the affected paths.
+    """
+
+    paths = set()
+    buf = os.read(self.fd, 64 * 1024)
+    offset = 0
+    while offset < len(buf):
+      wd, mask, cookie, length = self._event.unpack_from(buf, offset)
+      offset += self._event.size
+      name = buf[offset:offset + length].rstrip(b'\0')
+      offset += length
+
+      if mask & self.IN_Q_OVERFLOW:
+        # We lost events and have to check the whole tree.
+        paths.add(self.root)
+        continue
+      if mask & self.IN_IGNORED:
+        self.watches.pop(wd, None)
+        continue
+
+      dirname = self.watches.get(wd)
+      if dirname is None:
+        continue
+      if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+        paths.add(dirname)
+        continue
+
+      path = os.path.join(dirname, os.fsdecode(name))
+      if mask & self.IN_ISDIR and mask & self.IN_MOVED_FROM:
+        self.remove_tree(path)
+      elif mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+        self.add_tree(path)
+      elif mask & self.IN_CREATE:
+        # Wait for IN_CLOSE_WRITE before we read a new file.
+        continue
+      paths.add(path)
+
+    return paths
+
+  def __iter__(self):
+    while self.fd >= 0:
+      select.select([self.fd], [], [])
+      paths = self.read_events()
+      deadline = time.time() + self.delay * 10
+      while time.time() < deadline:
+        if not select.select([self.fd], [], [], self.delay)[0]:
+          break
+        paths |= self.read_events()
+      if paths:
+        yield paths
+
+
+class PollingWatcher(object):
+  """
+  Fallback for platforms without inotify. Takes a snapshot of the
+  modification time and size of every file under *root* every
+  *interval* seconds and yields the paths that changed in between.
+  """
+
+  def __init__(self, root, interval=30.0):
+    self.root = root
+    self.interval = interval
+    self.snapshot = self.take_snapshot()
+
+  def take_snapshot(self):
+    snapshot = {}
+    for _, _, _, files in pathutils.scandir_walk(self.root):
+      for entry in files:
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue
+        snapshot[entry.path] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+  def close(self):
+    pass
+
+  def __iter__(self):
+    while True:
+      time.sleep(self.interval)
+      snapshot = self.take_snapshot()
+      paths = set(self.snapshot.keys() ^ snapshot.keys())
+      paths.update(k for k, v in snapshot.items() if self.snapshot.get(k, v) != v)
+      self.snapshot = snapshot
+      if paths:
+        yield paths
+
+
+def new_watcher(root):
+  """
+  Returns an #InotifyWatcher for *root* if inotify is available,
+  otherwise a #PollingWatcher.
+  """
+
+  if InotifyWatcher.get_libc() is not None:
+    return InotifyWatcher(root, config.watch_delay)
+  logger.info('inotify is not available, polling every %ss',
+    config.watch_poll_interval)
+  return PollingWatcher(root, config.watch_poll_interval)
+
+
+def watch(jobs=1):
+  """
+  Synchronizes the database once and then keeps it up to date with the
+  changes in the library root directory until interrupted.
+  """
+
+  from .database import syncdb, sync_paths
+
+  # Set up the watcher before the initial sync so that we don't miss
+  # changes that happen in between. The syncs are full so that they
+  # also catch files that were changed in-place while we were not
+  # watching, e.g. before we started or when inotify events were lost.
+  watcher = new_watcher(config.library_root)
+  try:
+    syncdb(jobs=jobs, full=True)
+    logger.info('watching %s', config.library_root)
+    for paths in watcher:
+      if config.library_root in paths:
+        syncdb(jobs=jobs, full=True)
+      else:
+        sync_paths(paths)
+  finally:
+    watcher.close()
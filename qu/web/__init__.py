@@ -21,8 +21,20 @@
 import os
 import flask
 
-app = flask.Flask(__name__)
-app.static_folder = os.path.normpath(__file__ + '/../static')
-app.template_folder = os.path.normpath(__file__ + '/../templates')
 
-from . import views
+def create_app():
+  """
+  Creates the qu web application and initializes the database, see
+  #database.init(). Use `qu.web:create_app()` as the application of WSGI
+  servers like gunicorn. With `--preload`, the schema is then migrated
+  once before the workers are forked.
+  """
+
+  from .. import database
+  from .views import blueprint
+  database.init()
+  app = flask.Flask(__name__)
+  app.static_folder = os.path.normpath(__file__ + '/../static')
+  app.template_folder = os.path.normpath(__file__ + '/../templates')
+  app.register_blueprint(blueprint)
+  return app
@@ -0,0 +1,243 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from . import utils
+from .. import metrics
+from .views import stream_plan
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, unquote_to_bytes
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.http import http_date
+import asyncio
+import io
+import logging
+import re
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# Maximum size of the request line and headers and of request bodies.
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+STREAM_PATH = re.compile(r'^/stream/(\d+)$')
+
+REASONS = {
+  200: 'OK', 206: 'Partial Content', 304: 'Not Modified',
+  400: 'Bad Request', 404: 'Not Found', 416: 'Requested Range Not Satisfiable',
+  500: 'Internal Server Error',
+}
+
+
+class Request(object):
+
+  def __init__(self, method, target, version, headers, body=b''):
+    self.method = method
+    self.target = target
+    self.version = version
+    self.headers = headers
+    self.body = body
+    self.path, _, self.query = target.partition('?')
+
+  @property
+  def keep_alive(self):
+    connection = self.headers.get('Connection', '').lower()
+    if self.version == 'HTTP/1.0':
+      return connection == 'keep-alive'
+    return connection != 'close'
+
+
+class AsyncServer(object):
+  """
+  A small HTTP/1.1 server on #asyncio for many concurrent long-lived
+  audio streams. `/stream` requests are planned with #stream_plan() in
+  the thread pool and the file is then sent with #loop.sendfile(), which
+  uses `sendfile(2)` where possible and waits for the client to drain
+  the transport's write buffer, so a connection only holds on to a
+  small buffer. All other requests are passed to the WSGI *app* in the
+  bounded thread pool of *threads* threads.
+  """
+
+  def __init__(self, app, threads=8, keepalive_timeout=15.0):
+    self.app = app
+    self.executor = ThreadPoolExecutor(threads)
+    self.keepalive_timeout = keepalive_timeout
+
+  async def read_request(self, reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin1').split('\r\n')
+    method, target, version = lines[0].split(' ', 2)
+    headers = Headers()
+    for line in lines[1:]:
+      if line:
+        key, _, value = line.partition(':')
+        headers.add(key.strip(), value.strip())
+    length = int(headers.get('Content-Length') or 0)
+    if length < 0 or length > MAX_BODY_SIZE:
+      raise ValueError('invalid Content-Length')
+    body = await reader.readexactly(length) if length else b''
+    return Request(method, target, version, headers, body)
+
+  def write_head(self, writer, status, headers, keep_alive):
+    lines = ['HTTP/1.1 {} {}'.format(status, REASONS.get(status, ''))]
+    lines.extend('{}: {}'.format(k, v) for k, v in headers)
+    lines.append('Date: {}'.format(http_date()))
+    lines.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+
+  async def send_plan(self, request, writer, plan, keep_alive):
+    loop = asyncio.get_event_loop()
+    self.write_head(writer, plan.status, plan.headers, keep_alive)
+    if request.method == 'HEAD':
+      await writer.drain()
+    elif plan.filename is None:
+      writer.write(plan.body)
+      await writer.drain()
+    else:
+      metrics.ACTIVE_STREAMS.inc()
+      try:
+        with open(plan.filename, 'rb') as fp:
+          await writer.drain()
+          await loop.sendfile(writer.transport, fp, plan.offset, plan.count)
+        metrics.STREAM_BYTES.inc(plan.count)
+      finally:
+        metrics.ACTIVE_STREAMS.dec()
+
+  def get_environ(self, request, peername):
+    path = unquote_to_bytes(request.path).decode('latin1')
+    environ = {
+      'REQUEST_METHOD': request.method,
+      'SCRIPT_NAME': '',
+      'PATH_INFO': path,
+      'QUERY_STRING': request.query,
+      'SERVER_NAME': self.host,
+      'SERVER_PORT': str(self.port),
+      'SERVER_PROTOCOL': request.version,
+      'REMOTE_ADDR': peername[0] if peername else '',
+      'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+      'CONTENT_LENGTH': str(len(request.body)) if request.body else '',
+      'wsgi.version': (1, 0),
+      'wsgi.url_scheme': 'http',
+      'wsgi.input': io.BytesIO(request.body),
+      'wsgi.errors': sys.stderr,
+      'wsgi.multithread': True,
+      'wsgi.multiprocess': False,
+      'wsgi.run_once': False,
+    }
+    for key, value in request.headers.items():
+      key = 'HTTP_' + key.upper().replace('-', '_')
+      if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+        environ[key] = value if key not in environ else environ[key] + ',' + value
+    return environ
+
+  def call_app(self, environ):
+    """
+    Runs the WSGI application and returns the status code, headers and
+    the complete response body. Called in the thread pool.
+    """
+
+    response = []
+    def start_response(status, headers, exc_info=None):
+      response[:] = [int(status.split(' ', 1)[0]), headers]
+    result = self.app(environ, start_response)
+    try:
+      body = b''.join(result)
+    finally:
+      if hasattr(result, 'close'):
+        result.close()
+    status, headers = response
+    headers = [(k, v) for k, v in headers if k.lower() not in ('content-length', 'connection')]
+    headers.append(('Content-Length', str(len(body))))
+    return status, headers, body
+
+  async def handle(self, reader, writer):
+    loop = asyncio.get_event_loop()
+    peername = writer.get_extra_info('peername')
+    try:
+      while True:
+        try:
+          request = await asyncio.wait_for(self.read_request(reader),
+            self.keepalive_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+          break
+        except (asyncio.LimitOverrunError, ValueError):
+          plan = utils.plan_error(400, 'Bad Request')
+          self.write_head(writer, plan.status, plan.headers, False)
+          writer.write(plan.body)
+          break
+
+        keep_alive = request.keep_alive
+        match = STREAM_PATH.match(request.path)
+        if match and request.method in ('GET', 'HEAD'):
+          args = MultiDict(parse_qsl(request.query))
+          start = time.perf_counter()
+          plan = await loop.run_in_executor(self.executor, stream_plan,
+            int(match.group(1)), args, request.headers)
+          metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, ('stream',))
+          metrics.HTTP_REQUESTS.inc(labels=('stream', str(plan.status)))
+          await self.send_plan(request, writer, plan, keep_alive)
+          status = plan.status
+        else:
+          environ = self.get_environ(request, peername)
+          status, headers, body = await loop.run_in_executor(
+            self.executor, self.call_app, environ)
+          self.write_head(writer, status, headers, keep_alive)
+          if request.method != 'HEAD':
+            writer.write(body)
+          await writer.drain()
+
+        logger.info('%s "%s %s" %s', peername[0] if peername else '-',
+          request.method, request.target, status)
+        if not keep_alive:
+          break
+    except ConnectionError:
+      pass
+    except Exception:
+      logger.exception('error handling request')
+    finally:
+      writer.close()
+
+  async def serve_forever(self, host, port, sock=None):
+    if sock is not None:
+      host, port = sock.getsockname()[:2]
+      server = await asyncio.start_server(self.handle, sock=sock,
+        limit=MAX_HEADER_SIZE)
+    else:
+      server = await asyncio.start_server(self.handle, host, port,
+        limit=MAX_HEADER_SIZE, backlog=1024)
+    self.host, self.port = host, port
+    logger.info('serving on http://%s:%s', host, port)
+    async with server:
+      await server.serve_forever()
+
+
+def serve(app, host, port, threads=8, keepalive_timeout=15.0, sock=None):
+  """
+  Runs an #AsyncServer for *app* until interrupted. If a listening
+  *sock* is specified, it is served instead of binding *host* and *port*.
+  """
+
+  server = AsyncServer(app, threads, keepalive_timeout)
+  try:
+    asyncio.run(server.serve_forever(host, port, sock))
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,121 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def listen(host, port, backlog=1024):
+  """
+  Creates a TCP socket that listens on *host* and *port*. Forked workers
+  inherit the socket and accept connections from it concurrently.
+  """
+
+  family = socket.AF_INET6 if ':' in host else socket.AF_INET
+  sock = socket.socket(family, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind((host, port))
+  sock.listen(backlog)
+  sock.set_inheritable(True)
+  return sock
+
+
+def serve_threaded(app, sock):
+  """
+  Serves the WSGI *app* on the listening *sock* with the threaded
+  werkzeug server until interrupted.
+  """
+
+  from werkzeug.serving import make_server
+  host, port = sock.getsockname()[:2]
+  server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+def run_workers(workers, target):
+  """
+  Forks *workers* processes that call *target* and waits for them. A
+  worker that exits is replaced by a new one until the master process
+  is interrupted or terminated, which then terminates all workers.
+  """
+
+  children = {}
+
+  def spawn():
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      code = 0
+      try:
+        target()
+      except KeyboardInterrupt:
+        pass
+      except BaseException:
+        logger.exception('worker %d failed', os.getpid())
+        code = 1
+      finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+    children[pid] = time.time()
+
+  def terminate(signum, frame):
+    raise SystemExit(0)
+
+  signal.signal(signal.SIGTERM, terminate)
+  try:
+    for i in range(workers):
+      spawn()
+    logger.info('started %d workers', workers)
+    while True:
+      pid, status = os.wait()
+      started = children.pop(pid, None)
+      if started is None:
+        continue
+      if os.WIFSIGNALED(status):
+        logger.warning('worker %d was killed by signal %d', pid, os.WTERMSIG(status))
+      else:
+        logger.warning('worker %d exited with status %d', pid, os.WEXITSTATUS(status))
+      # Don't fork in a tight loop if the workers fail on startup.
+      if time.time() - started < 1.0:
+        time.sleep(1.0)
+      spawn()
+  except (KeyboardInterrupt, SystemExit):
+    pass
+  finally:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for pid in children:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError as exc:
+        if exc.errno != errno.ESRCH:
+          raise
+    for pid in children:
+      os.waitpid(pid, 0)
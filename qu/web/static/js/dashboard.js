@@ -1,8 +1,20 @@
 
+// State of the track list, which is loaded page by page from the
+// /api/tracks endpoint as the user scrolls down.
+var library = {
+  sort: 'default',
+  order: 'asc',
+  cursor: null,
+  done: false,
+  request: null,
+  searchTimer: null
+};
+
+
 function play(trackId) {
   var track = document.getElementById('track-' + trackId);
   var audio = document.getElementById('audio');
-  audio.setAttribute('src', '/stream/' + trackId);
+  audio.setAttribute('src', '/stream/' + trackId + '?strip=1');
   audio.setAttribute('type', track.getAttribute('data-track-mime'));
   audio.load();
   audio.play();
@@ -14,10 +26,173 @@ function play(trackId) {
   var currentAlbum = document.getElementById('current-album');
   currentAlbum.innerText = track.getAttribute('data-track-album');
   var currentAlbumPic = document.getElementById('current-album-pic');
-  currentAlbumPic.setAttribute('src', '/pic/' + trackId);
+  currentAlbumPic.setAttribute('src', '/pic/' + trackId + '?size=128');
+}
+
+
+function createCell(row, text) {
+  var cell = document.createElement('td');
+  cell.textContent = text || '';
+  row.appendChild(cell);
+  return cell;
+}
+
+
+function formatDuration(seconds) {
+  if (seconds === null || seconds === undefined) {
+    return '';
+  }
+  seconds = Math.round(seconds);
+  var secs = seconds % 60;
+  return Math.floor(seconds / 60) + ':' + (secs < 10 ? '0' : '') + secs;
+}
+
+
+function createTrackRow(track) {
+  var row = document.createElement('tr');
+  row.className = 'track';
+  row.id = 'track-' + track.id;
+  row.setAttribute('data-track-id', track.id);
+  row.setAttribute('data-track-title', track.title || '');
+  row.setAttribute('data-track-artist', track.artist || '');
+  row.setAttribute('data-track-album', track.album || '');
+  row.setAttribute('data-track-genre', track.genre || '');
+  row.setAttribute('data-track-mime', track.mime);
+
+  var link = document.createElement('a');
+  link.className = 'icon icon-play';
+  link.href = '#';
+  link.onclick = function() { play(track.id); return false; };
+  createCell(row).appendChild(link);
+
+  var check = document.createElement('img');
+  check.width = 12;
+  check.src = '/static/img/' + (track.has_cover ? 'check.png' : 'error.png');
+  createCell(row).appendChild(check);
+
+  var pic = document.createElement('img');
+  pic.width = 16;
+  pic.height = 16;
+  pic.setAttribute('loading', 'lazy');
+  pic.src = '/pic/' + track.id + '?size=32';
+  createCell(row).appendChild(pic);
+
+  createCell(row, track.title);
+  createCell(row, track.artist);
+  createCell(row, track.album);
+  createCell(row, formatDuration(track.duration));
+  createCell(row, track.genre);
+  createCell(row, track.path);
+  return row;
+}
+
+
+function showTracks(tracks, append) {
+  var tbody = document.getElementById('tracks');
+  if (!append) {
+    tbody.innerHTML = '';
+  }
+  for (var i = 0; i < tracks.length; ++i) {
+    tbody.appendChild(createTrackRow(tracks[i]));
+  }
+}
+
+
+function loadTracks() {
+  if (library.request || library.done) {
+    return;
+  }
+  var url = '/api/tracks?sort=' + library.sort + '&order=' + library.order;
+  if (library.cursor) {
+    url += '&cursor=' + encodeURIComponent(library.cursor);
+  }
+
+  var request = new XMLHttpRequest();
+  request.open('GET', url);
+  request.onload = function() {
+    if (library.request !== request) {
+      return;  // The sort order changed in the meantime.
+    }
+    library.request = null;
+    if (request.status != 200) {
+      return;
+    }
+    var data = JSON.parse(request.responseText);
+    showTracks(data.tracks, true);
+    library.cursor = data.next;
+    library.done = !data.next;
+    fillLibrary();
+  };
+  library.request = request;
+  request.send();
+}
+
+
+function fillLibrary() {
+  // Load the next page when the end of the table is less than a
+  // screen away from being visible.
+  var container = document.getElementById('library');
+  if (container.scrollTop + 2 * container.clientHeight >= container.scrollHeight) {
+    loadTracks();
+  }
+}
+
+
+function resetTracks() {
+  library.cursor = null;
+  library.done = false;
+  library.request = null;
+  document.getElementById('tracks').innerHTML = '';
+  document.getElementById('library').scrollTop = 0;
 }
 
 
 function sortTracks(attr) {
-  // TODO
+  var sort = attr.replace('data-track-', '');
+  if (library.sort == sort) {
+    library.order = (library.order == 'asc' ? 'desc' : 'asc');
+  }
+  else {
+    library.sort = sort;
+    library.order = 'asc';
+  }
+  document.getElementById('search').value = '';
+  resetTracks();
+  loadTracks();
+}
+
+
+function searchTracks() {
+  var query = document.getElementById('search').value.trim();
+  resetTracks();
+  if (!query) {
+    loadTracks();
+    return;
+  }
+
+  // Search results are not paged, don't load more when scrolling.
+  library.done = true;
+  var request = new XMLHttpRequest();
+  request.open('GET', '/api/search?limit=200&q=' + encodeURIComponent(query));
+  request.onload = function() {
+    if (library.request !== request) {
+      return;  // The query changed in the meantime.
+    }
+    library.request = null;
+    if (request.status == 200) {
+      showTracks(JSON.parse(request.responseText).tracks, false);
+    }
+  };
+  library.request = request;
+  request.send();
 }
+
+
+window.addEventListener('load', function() {
+  document.getElementById('library').addEventListener('scroll', fillLibrary);
+  document.getElementById('search').addEventListener('input', function() {
+    clearTimeout(library.searchTimer);
+    library.searchTimer = setTimeout(searchTracks, 150);
+  });
+  loadTracks();
+});
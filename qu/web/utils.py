@@ -18,51 +18,263 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from flask import request
+from .. import config, metrics
+from flask import request, Response
+from werkzeug.http import http_date, parse_date, parse_etags, parse_if_range_header, quote_etag
+from werkzeug.wsgi import wrap_file
+from urllib.parse import quote
+import calendar
+import io
+import os
 
+#: Returned by #parse_range() if the requested range can not be satisfied.
+UNSATISFIABLE = object()
 
-def stream_file(filename, mode='rb', chunksize=2048, range=NotImplemented):
+
+def stream_file(fp, length=None, chunksize=64 * 1024):
   """
-  Stream the contents of the specified #filename with the specified
-  #chunksize and #range. If #range is #NotImplemented, it will default
-  be read from the current request's `Range` header. If #range is None,
-  the whole file will be streamed.
+  Generator that reads up to *length* bytes from the file object *fp*,
+  starting from its current position, in chunks of *chunksize* bytes.
+  If *length* is None, the file is read up to its end. The file is
+  closed when the generator is exhausted or closed.
   """
 
-  if range is NotImplemented:
-    range = parse_range(request.headers.get('Range'))
-  elif range is None:
-    range = (0, None)
-  print(range)
+  with fp:
+    while length is None or length > 0:
+      size = chunksize if length is None else min(chunksize, length)
+      data = fp.read(size)
+      if not data:
+        break
+      if length is not None:
+        length -= len(data)
+      metrics.STREAM_BYTES.inc(len(data))
+      yield data
 
-  with open(filename, mode) as fp:
-    fp.seek(range[0])
-    bytes_read = 0
-    while True:
-      if range[1] is not None and bytes_read + chunksize > range[1]:
-        data = fp.read(range[1] - bytes_read)
-      else:
-        data = fp.read(chunksize)
 
-      if not data: break
-      yield data
+class StreamFile(io.BufferedReader):
+  """
+  A file that counts as an active stream in the metrics until it is
+  closed. *count* bytes are then added to the streamed bytes, for files
+  that the server sends without reading them through Python.
+  """
+
+  def __init__(self, filename, count=0):
+    super().__init__(io.FileIO(filename, 'rb'))
+    self._count = count
+    metrics.ACTIVE_STREAMS.inc()
 
+  def close(self):
+    if not self.closed:
+      metrics.ACTIVE_STREAMS.dec()
+      metrics.STREAM_BYTES.inc(self._count)
+    super().close()
 
-def parse_range(range):
+
+def parse_range(header, size):
   """
-  Parse an HTTP range. Only supports byte ranges. Returns a tuple of
-  the start and end offsets, where the end can be #None to indicate
-  all up to the file's end.
+  Parse the HTTP `Range` *header* for a resource of *size* bytes. Only
+  supports a single byte range. Returns a tuple of the start and stop
+  offsets (the stop offset being exclusive), #UNSATISFIABLE if the range
+  does not overlap with the resource, or None if the header is missing
+  or not supported and the whole resource should be sent.
   """
 
-  if not range or not range.startswith('bytes='):
-    return (0, None)
+  if not header or not header.startswith('bytes='):
+    return None
 
-  parts = range[6:].split('-')
-  if len(parts) != 2:
-    return (0, None)
+  parts = header[6:].strip().split('-')
+  if len(parts) != 2 or ',' in header:
+    return None
 
   try:
-    return tuple(int(x) if x else None for x in parts)
+    start, end = (int(x) if x.strip() else None for x in parts)
   except ValueError:
-    return (0, None)
+    return None
+
+  if start is None:
+    # Suffix range, the last *end* bytes of the resource.
+    if end is None:
+      return None
+    if end == 0:
+      return UNSATISFIABLE
+    return (max(size - end, 0), size)
+  if end is not None and end < start:
+    return None
+  if start >= size:
+    return UNSATISFIABLE
+  if end is None or end >= size:
+    end = size - 1
+  return (start, end + 1)
+
+
+def _timestamp(date):
+  return calendar.timegm(date.utctimetuple())
+
+
+def is_not_modified(etag, last_modified, headers=None):
+  """
+  Evaluates the `If-None-Match` and `If-Modified-Since` *headers* (of
+  the current request by default) against the *etag* and the
+  *last_modified* timestamp of a resource. Returns True if the client's
+  copy is up to date and a `304 Not Modified` response can be sent.
+  """
+
+  if headers is None:
+    headers = request.headers
+  if_none_match = headers.get('If-None-Match')
+  if if_none_match:
+    return parse_etags(if_none_match).contains_weak(etag)
+  if_modified_since = parse_date(headers.get('If-Modified-Since'))
+  if if_modified_since and last_modified is not None:
+    return int(last_modified) <= _timestamp(if_modified_since)
+  return False
+
+
+def is_range_valid(etag, last_modified, headers=None):
+  """
+  Evaluates the `If-Range` header in *headers* (of the current request
+  by default). Returns False if it doesn't match the resource and the
+  `Range` header must be ignored.
+  """
+
+  if headers is None:
+    headers = request.headers
+  if_range = parse_if_range_header(headers.get('If-Range'))
+  if if_range.etag is not None:
+    return if_range.etag == etag
+  if if_range.date is not None:
+    return last_modified is not None and int(last_modified) == _timestamp(if_range.date)
+  return True
+
+
+class FilePlan(object):
+  """
+  Describes the response to a request for a file, without doing any
+  I/O, so that it can be carried out by the WSGI application (see
+  #plan_response()) as well as by the #asyncserver. The response body
+  is either *body* or *count* bytes of the file *filename* starting at
+  *offset*. *eof* is True if the body extends to the end of the file.
+  """
+
+  def __init__(self, status, headers, body=b'', filename=None, offset=0,
+      count=0, eof=False):
+    self.status = status
+    self.headers = headers
+    self.body = body
+    self.filename = filename
+    self.offset = offset
+    self.count = count
+    self.eof = eof
+
+  def __repr__(self):
+    return 'FilePlan(status={!r}, filename={!r}, offset={}, count={})'.format(
+      self.status, self.filename, self.offset, self.count)
+
+
+def plan_error(status, message):
+  """
+  Returns a #FilePlan for a plain text error *message*.
+  """
+
+  body = message.encode('utf8')
+  return FilePlan(status, [('Content-Type', 'text/plain; charset=utf-8'),
+    ('Content-Length', str(len(body)))], body)
+
+
+def _validators(etag, last_modified):
+  headers = []
+  if etag is not None:
+    headers.append(('ETag', quote_etag(etag)))
+  if last_modified is not None:
+    headers.append(('Last-Modified', http_date(last_modified)))
+  return headers
+
+
+def plan_not_modified(etag, last_modified):
+  """
+  Returns a #FilePlan for a `304 Not Modified` response with the
+  validators of a resource.
+  """
+
+  return FilePlan(304, _validators(etag, last_modified))
+
+
+def plan_file(filename, mimetype, headers, dbpath=None, etag=None,
+    last_modified=None, offset=0, length=None):
+  """
+  Returns a #FilePlan for sending the file *filename* that honors the
+  `Range` and `If-Range` request *headers*.
+
+  If the `stream_sendfile` configuration value is `'x-sendfile'` or
+  `'x-accel-redirect'`, the response only instructs the fronting web
+  server to send the file, which also handles the `Range` header. The
+  latter requires the *dbpath* of the file in the library.
+
+  If an *etag* and/or *last_modified* timestamp is specified, they are
+  sent with the response and used to evaluate the `If-Range` header.
+  Use #is_not_modified() to check for a 304 response beforehand.
+
+  The response can be limited to a window of *length* bytes starting at
+  *offset* in the file (up to the end of the file if *length* is None).
+  The window is then treated as the resource, ie. byte ranges are
+  relative to it. The *etag* must identify the window. Windows are
+  always sent by the application.
+  """
+
+  whole_file = offset == 0 and length is None
+  content_type = [('Content-Type', mimetype)]
+  if whole_file and config.stream_sendfile == 'x-accel-redirect' and dbpath is not None:
+    path = config.stream_accel_prefix + quote(dbpath)
+    return FilePlan(200, content_type + [('X-Accel-Redirect', path)])
+  elif whole_file and config.stream_sendfile == 'x-sendfile':
+    return FilePlan(200, content_type + [('X-Sendfile', filename)])
+
+  file_size = os.stat(filename).st_size
+  offset = min(offset, file_size)
+  size = file_size - offset if length is None else min(length, file_size - offset)
+  byte_range = None
+  if etag is None or is_range_valid(etag, last_modified, headers):
+    byte_range = parse_range(headers.get('Range'), size)
+  if byte_range is UNSATISFIABLE:
+    plan = plan_error(416, 'Requested range not satisfiable')
+    plan.headers.append(('Content-Range', 'bytes */{}'.format(size)))
+    plan.headers.append(('Accept-Ranges', 'bytes'))
+    return plan
+
+  if byte_range is None:
+    start, stop, status = 0, size, 200
+  else:
+    (start, stop), status = byte_range, 206
+
+  headers = content_type + [('Accept-Ranges', 'bytes')]
+  headers += _validators(etag, last_modified)
+  headers.append(('Content-Length', str(stop - start)))
+  if status == 206:
+    headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, stop - 1, size)))
+  return FilePlan(status, headers, filename=filename, offset=offset + start,
+    count=stop - start, eof=offset + stop == file_size)
+
+
+def plan_response(plan, chunksize=64 * 1024):
+  """
+  Carries out a #FilePlan in the current request and returns the
+  #Response. If the file is sent up to its end, the server's
+  `wsgi.file_wrapper` is used, which allows servers that support it to
+  send the file without copying it through Python.
+  """
+
+  if plan.filename is None:
+    return Response(plan.body, plan.status, plan.headers)
+
+  fp = StreamFile(plan.filename, plan.count if plan.eof else 0)
+  try:
+    fp.seek(plan.offset)
+    if plan.eof:
+      body = wrap_file(request.environ, fp, chunksize)
+    else:
+      body = stream_file(fp, plan.count, chunksize)
+  except:
+    fp.close()
+    raise
+  return Response(body, plan.status, plan.headers, direct_passthrough=True)
+
@@ -18,45 +18,331 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from . import app, utils
+from . import utils
 from .. import config
+from ..metadata import seek_offset
 from ..pathutils import from_dbpath
-from ..database import Session, Track
-from ..metadata import read_metadata
-from flask import request, render_template, stream_with_context, redirect, url_for, Response
+from .. import orm
+from ..database import Session, Track, Artist, Album, Genre, BROWSE_ORDERS
+from .. import covers, metrics
+from flask import Blueprint, request, render_template, redirect, url_for, jsonify, Response, g
+from werkzeug.wsgi import wrap_file
+import base64
+import binascii
+import json
 import os
+import re
+import time
 
+blueprint = Blueprint('qu', __name__)
 
-@app.route('/')
-@Session.wraps
+# Number of seconds that clients may cache cover art from /cover.
+COVER_MAX_AGE = 365 * 24 * 3600
+
+# Format of the cover art hashes in /cover URLs.
+COVER_DIGEST = re.compile(r'^[0-9a-f]{40}$')
+
+# Maximum number of tracks that /api/tracks returns per page.
+MAX_PAGE_SIZE = 500
+
+# Columns that /api/tracks can be filtered by and their types.
+BROWSE_FILTERS = {'artist': str, 'album': str, 'grouping': str, 'genre': str,
+  'artist_id': int, 'album_id': int, 'genre_id': int}
+
+
+def encode_cursor(key):
+  data = json.dumps(key, separators=(',', ':')).encode('utf8')
+  return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+  try:
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+  except (TypeError, UnicodeError, binascii.Error) as exc:
+    raise ValueError(exc)
+  if not isinstance(key, list):
+    raise ValueError('cursor must be a list')
+  if not all(x is None or isinstance(x, (str, int, float)) for x in key):
+    raise ValueError('cursor must only contain strings, numbers and nulls')
+  return key
+
+
+@blueprint.before_app_request
+def start_request_metrics():
+  g.request_start_time = time.perf_counter()
+  metrics.start_request()
+
+
+@blueprint.after_app_request
+def record_request_metrics(response):
+  view = ((request.endpoint or 'unknown').rpartition('.')[2],)
+  metrics.HTTP_REQUESTS.inc(labels=view + (str(response.status_code),))
+  metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - g.request_start_time, view)
+  sql_count, sql_time = metrics.request_sql_stats()
+  metrics.REQUEST_SQL_QUERIES.observe(sql_count, view)
+  metrics.REQUEST_SQL_DURATION.observe(sql_time, view)
+  return response
+
+
+@blueprint.route('/metrics')
+def metrics_view():
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@blueprint.route('/')
 def home():
-  tracks = Session.current().query(Track).order_by(Track.grouping, Track.artist, Track.album, Track.title).all()
-  return render_template('dashboard.html', tracks=tracks)
+  return render_template('dashboard.html')
 
 
-@app.route('/stream/<int:track_id>')
+def track_json(track):
+  """
+  Returns the representation of a #Track in the JSON API.
+  """
+
+  return {
+    'id': track.id,
+    'mime': track.mime,
+    'path': track.path,
+    'title': track.title,
+    'artist': track.artist,
+    'album': track.album,
+    'grouping': track.grouping,
+    'genre': track.genre,
+    'composer': track.composer,
+    'track': track.track,
+    'set': track.set,
+    'year': track.year,
+    'has_cover': bool(track.has_cover),
+    'duration': track.duration,
+    'bitrate': track.bitrate,
+    'artist_id': track.artist_id,
+    'album_id': track.album_id,
+    'genre_id': track.genre_id,
+  }
+
+
+def paginate(query, key):
+  """
+  Returns a page of the results of *query* sorted by the list of *key*
+  columns using keyset pagination, with the `limit` and `cursor` query
+  parameters of the current request. Returns a tuple of the results and
+  the cursor of the next page or None. Raises a #ValueError if the
+  cursor is invalid.
+  """
+
+  limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_PAGE_SIZE)
+  if request.args.get('cursor'):
+    after = decode_cursor(request.args['cursor'])
+    if len(after) != len(key):
+      raise ValueError('invalid cursor')
+    query = query.filter(orm.tuple_(*key) > orm.tuple_(*after))
+  items = query.order_by(*key).limit(limit).all()
+  if len(items) < limit:
+    return items, None
+  return items, encode_cursor([getattr(items[-1], x.key) for x in key])
+
+
+@blueprint.route('/api/artists')
 @Session.wraps
-def stream(track_id):
+def api_artists():
+  """
+  Returns a page of artists with their number of tracks as JSON, see
+  #paginate() for the query parameters.
+  """
+
+  try:
+    artists, cursor = paginate(Session.current().query(Artist), [Artist.name, Artist.id])
+  except ValueError:
+    return jsonify(error='invalid cursor'), 400
+  return jsonify(next=cursor, artists=[{'id': x.id, 'name': x.name,
+    'track_count': x.track_count, 'total_size': x.total_size} for x in artists])
+
+
+@blueprint.route('/api/albums')
+@Session.wraps
+def api_albums():
+  """
+  Returns a page of albums with their number of tracks as JSON. Albums
+  can be filtered by their artist with `artist_id`.
+  """
+
+  query = Session.current().query(Album)
+  artist_id = request.args.get('artist_id', type=int)
+  if artist_id is not None:
+    query = query.filter(Album.artist_id == artist_id)
+  try:
+    albums, cursor = paginate(query, [Album.title, Album.id])
+  except ValueError:
+    return jsonify(error='invalid cursor'), 400
+  return jsonify(next=cursor, albums=[{'id': x.id, 'title': x.title,
+    'artist_id': x.artist_id, 'track_count': x.track_count,
+    'total_size': x.total_size, 'cover_hash': x.cover_hash} for x in albums])
+
+
+@blueprint.route('/api/genres')
+@Session.wraps
+def api_genres():
+  """
+  Returns all genres with their number of tracks as JSON.
+  """
+
+  genres = Session.current().query(Genre).order_by(Genre.name).all()
+  return jsonify(genres=[{'id': x.id, 'name': x.name,
+    'track_count': x.track_count} for x in genres])
+
+
+@blueprint.route('/api/tracks')
+@Session.wraps
+def api_tracks():
+  """
+  Returns a page of tracks as JSON. Supported query parameters are
+
+  * `sort` - one of the #database.BROWSE_ORDERS, defaults to `default`
+  * `order` - `asc` or `desc`
+  * `limit` - the maximum number of tracks to return
+  * `cursor` - the `next` value of the previous page
+  * `artist`, `album`, `grouping`, `genre` - filter by exact value
+  * `artist_id`, `album_id`, `genre_id` - filter by #Catalogue entity
+  """
+
+  sort = request.args.get('sort', 'default')
+  if sort not in BROWSE_ORDERS:
+    return jsonify(error='invalid sort order'), 400
+  descending = request.args.get('order', 'asc') == 'desc'
+  limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_PAGE_SIZE)
+  filters = {k: request.args.get(k, type=t) for k, t in BROWSE_FILTERS.items()}
+  filters = {k: v for k, v in filters.items() if v is not None}
+
+  after = None
+  if request.args.get('cursor'):
+    try:
+      after = decode_cursor(request.args['cursor'])
+    except ValueError:
+      return jsonify(error='invalid cursor'), 400
+    if len(after) != len(BROWSE_ORDERS[sort]) + 1:
+      return jsonify(error='invalid cursor'), 400
+
+  tracks, last = Track.browse(sort, descending, filters, after, limit)
+  return jsonify(
+    tracks=[track_json(x) for x in tracks],
+    next=encode_cursor(last) if last is not None else None)
+
+
+@blueprint.route('/api/search')
+@Session.wraps
+def api_search():
+  """
+  Returns the tracks that match the search query `q` as JSON. The
+  number of results can be limited with `limit`.
+  """
+
+  limit = min(max(request.args.get('limit', 50, type=int), 1), MAX_PAGE_SIZE)
+  tracks = Track.search(request.args.get('q', ''), limit)
+  return jsonify(tracks=[track_json(x) for x in tracks])
+
+
+@Session.wraps
+def stream_plan(track_id, args, headers):
+  """
+  Returns the #utils.FilePlan for streaming the track with the ID
+  *track_id* given the query *args* and the request *headers*. This is
+  shared by the #stream() view and the #asyncserver.
+  """
+
   track = Session.current().query(Track).get(track_id)
   if not track:
-    return "Track not found", 404
+    return utils.plan_error(404, "Track not found")
+
+  etag = track.get_etag()
+
+  # With ?t=SECONDS, the stream starts at the frame boundary from the
+  # seek table that is closest before the requested time.
+  offset, length, seek_time = 0, None, None
+  seconds = args.get('t', type=float)
+  if seconds and track.seek_table:
+    entry = seek_offset(track.seek_table, seconds)
+    if entry is None:
+      return utils.plan_error(400, "Seek time out of range")
+    offset, seek_time = track.audio_offset + entry[0], entry[1]
+    etag = '{}-t{}'.format(etag, int(seek_time))
+
+  # With ?strip=1, only the audio frames are sent, skipping the tags
+  # and embedded cover art that clients fetch from /pic anyway. MPEG
+  # frames are self-contained, so no header needs to be rebuilt.
+  if args.get('strip', type=int) and track.audio_length:
+    offset = max(offset, track.audio_offset)
+    length = track.audio_offset + track.audio_length - offset
+    etag = '{}-a'.format(etag)
+
+  # Answer repeated requests from the validators stored in the database
+  # without touching the file.
+  if utils.is_not_modified(etag, track.mtime, headers):
+    return utils.plan_not_modified(etag, track.mtime)
+
   filename = os.path.join(config.library_root, from_dbpath(track.path))
   if not os.path.isfile(filename):
-    return "Track not found", 404
+    return utils.plan_error(404, "Track not found")
+
+  plan = utils.plan_file(filename, track.mime, headers, track.path, etag,
+    track.mtime, offset, length)
+  if seek_time is not None:
+    plan.headers.append(('X-Seek-Time', str(seek_time)))
+  return plan
 
-  return Response(stream_with_context(utils.stream_file(filename)), 200, [
-    ('Content-type', track.mime), ('Accept-Ranges', 'bytes')])
+
+@blueprint.route('/stream/<int:track_id>')
+def stream(track_id):
+  plan = stream_plan(track_id, request.args, request.headers)
+  return utils.plan_response(plan)
 
 
-@app.route('/pic/<int:track_id>')
+@blueprint.route('/pic/<int:track_id>')
 @Session.wraps
 def pic(track_id):
+  """
+  Redirects to the #cover() of the track. The redirect must not be
+  cached as the cover of the track may change.
+  """
+
   track = Session.current().query(Track).get(track_id)
-  if track:
-    filename = os.path.join(config.library_root, from_dbpath(track.path))
-    if filename:
-      metadata = read_metadata(filename)
-      if metadata and 'cover' in metadata:
-        cover = metadata['cover']
-        return Response(cover.data, 200, [('Content-type', cover.mime)])
-  return redirect(url_for('static', filename='img/nocover.png'))
+  if track and track.cover_hash:
+    size = request.args.get('size', type=int)
+    response = redirect(url_for('.cover', digest=track.cover_hash, size=size))
+  else:
+    response = redirect(url_for('static', filename='img/nocover.png'))
+  response.cache_control.no_cache = True
+  return response
+
+
+@blueprint.route('/cover/<digest>')
+@Session.wraps
+def cover(digest):
+  if not COVER_DIGEST.match(digest):
+    return Response('Not Found', 404)
+  mime = Session.current().query(Track.cover_mime).filter_by(cover_hash=digest).first()
+  filename = covers.get_filename(digest)
+  etag = digest
+
+  # Serve the smallest thumbnail that is at least as large as the
+  # requested size, if there is one.
+  size = request.args.get('size', type=int)
+  thumbnail = covers.find_thumbnail(digest, size) if size else None
+  if thumbnail:
+    filename = thumbnail[1]
+    mime, etag = ('image/jpeg',), '{}-{}'.format(etag, thumbnail[0])
+
+  if mime is None or not os.path.isfile(filename):
+    return Response('Not Found', 404)
+
+  # The cover store is content-addressed, thus the file for a hash
+  # never changes and can be cached indefinitely.
+  if request.if_none_match.contains(etag):
+    response = Response(status=304)
+  else:
+    response = Response(wrap_file(request.environ, open(filename, 'rb')),
+      200, mimetype=mime[0], direct_passthrough=True)
+    response.content_length = os.path.getsize(filename)
+  response.set_etag(etag)
+  response.cache_control.public = True
+  response.cache_control.max_age = COVER_MAX_AGE
+  return response
@@ -6,11 +6,12 @@ here = dirname(__file__)
 host = '0.0.0.0'
 port = 5000
 
-# Extension modules for the qu.musicfinder.MusicFinder class.
-# This specifies what music file types are supported by qu.
-musicfinder_extensions = [
-  'qu.ext.mutagen_mp3',
-]
+# Maps the file suffixes that are supported by qu to the extension
+# modules that provide their metadata. A module is imported the first
+# time a file with one of its suffixes is read.
+metadata_providers = {
+  '.mp3': 'qu.ext.mutagen_mp3',
+}
 
 # Path to your music library root directory. This directory
 # will be scanned for music.
@@ -19,3 +20,74 @@ library_root = '/Users/niklas/Music/iTunes/iTunes Media'
 # URL to the database that caches the library information.
 database_url = 'sqlite:///' + join(here, 'database.sqlite')
 database_encoding = 'utf-8'
+
+# Size of the database connection pool of every process and the number
+# of connections it may open on top of that. With `--web --workers N`,
+# the server opens up to N times as many connections. Not used for
+# SQLite, which opens a connection per session.
+database_pool_size = 5
+database_max_overflow = 10
+
+# Pragmas that are set on every connection to an SQLite database. The
+# write-ahead log lets the web app read while --syncdb writes.
+sqlite_pragmas = {
+  'journal_mode': 'wal',
+  'synchronous': 'normal',
+  'cache_size': -64 * 1024,  # in KiB
+  'mmap_size': 256 * 1024 * 1024,
+  'busy_timeout': 10000,  # in milliseconds
+}
+
+# --syncdb commits its progress after this many files or seconds,
+# whichever comes first, so that it never holds the write lock long.
+sync_commit_files = 2000
+sync_commit_interval = 5.0
+
+# If enabled, --syncdb does not look into directories whose modification
+# time and number of entries did not change since the last sync. This
+# makes a resync of a large library much faster, but it misses files
+# that were changed in-place (e.g. retagged), as that doesn't change the
+# directory. Those are only picked up by --syncdb --full and --watch.
+sync_skip_directories = False
+
+# If enabled, --syncdb and --watch index the MPEG frames of every new or
+# changed file, which gives exact durations and enables seeking with
+# /stream?t= and ?strip=1. This reads every byte of the files and takes
+# about 30 times longer than reading the tags, thus it is disabled by
+# default. Durations are then estimated from the first frame. Run
+# `python -m qu --index-audio` to index the tracks that have no index.
+sync_audio_index = False
+
+# Directory in which the cover art of the tracks is stored.
+cover_cache_dir = join(here, 'covers')
+
+# Sizes in pixels of the cover art thumbnails that are rendered with
+# --build-thumbnails (requires Pillow).
+cover_thumbnail_sizes = [32, 128, 512]
+
+# How /stream sends audio files. None sends them from the web app,
+# 'x-sendfile' or 'x-accel-redirect' let a fronting web server send
+# them. For 'x-accel-redirect' (nginx), stream_accel_prefix must be an
+# internal location that maps to library_root.
+stream_sendfile = None
+stream_accel_prefix = '/_library/'
+
+# Number of seconds that --watch waits for more filesystem events
+# before it updates the database, and the interval in which it checks
+# the library for changes when inotify is not available.
+watch_delay = 1.0
+watch_poll_interval = 30.0
+
+# Number of threads in which --web --async runs database queries and
+# the requests to the web app other than /stream, and the number of
+# seconds that it keeps idle connections open.
+async_threads = 8
+async_keepalive_timeout = 15.0
+
+# File in which the metadata read from the library is cached by file
+# identity, which avoids reading unchanged files again when the database
+# is rebuilt. None disables the cache. The cache is limited to about
+# metadata_cache_size bytes. It can be shared by --syncdb and --watch,
+# which commit to it every few seconds.
+metadata_cache = None
+metadata_cache_size = 256 * 1024 * 1024
@@ -19,7 +19,9 @@
 # THE SOFTWARE.
 
 from qu import config
-from qu.web import app
+from qu.web import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
   app.run(host=config.host, port=config.port, debug=True)
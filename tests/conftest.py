@@ -0,0 +1,41 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from qu import config, database
+import pytest
+
+
+@pytest.fixture
+def library(tmpdir, monkeypatch):
+  """
+  Configures qu to use an empty library, cover store and database in a
+  temporary directory. Returns the library root.
+  """
+
+  root = str(tmpdir.join('library'))
+  monkeypatch.setattr(config, 'database_url', 'sqlite:///' + str(tmpdir.join('qu.sqlite')))
+  monkeypatch.setattr(config, 'library_root', root)
+  monkeypatch.setattr(config, 'cover_cache_dir', str(tmpdir.join('covers')))
+  monkeypatch.setattr(config, 'metadata_cache', None)
+  monkeypatch.setattr(database, 'engine', None)
+  monkeypatch.setattr(database, 'fts_available', False)
+  yield root
+  if database.engine is not None:
+    database.engine.dispose()
@@ -0,0 +1,88 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from mutagen.id3 import ID3, APIC, TALB, TIT2, TPE1
+from qu import database
+import os
+import pytest
+import sqlite3
+import time
+
+# A silent MPEG-1 Layer III frame at 128 kbit/s and 44.1 kHz.
+FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413
+
+# The schema of the database before it was versioned.
+BASELINE_SCHEMA = '''
+CREATE TABLE track (
+  id INTEGER NOT NULL, mime VARCHAR, path VARCHAR, last_update_time INTEGER,
+  title VARCHAR, artist VARCHAR, album VARCHAR, modified_by VARCHAR,
+  grouping VARCHAR, copyright VARCHAR, publisher VARCHAR, composer VARCHAR,
+  track INTEGER, "set" INTEGER, bmp INTEGER, year INTEGER, genre VARCHAR,
+  codec VARCHAR, encoded_by VARCHAR, has_cover BOOLEAN,
+  PRIMARY KEY (id), UNIQUE (path), CHECK (has_cover IN (0, 1))
+)
+'''
+
+
+def write_track(filename, title, artist, album, cover):
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  with open(filename, 'wb') as fp:
+    fp.write(FRAME * 40)
+  tags = ID3()
+  tags.add(TIT2(encoding=3, text=title))
+  tags.add(TPE1(encoding=3, text=artist))
+  tags.add(TALB(encoding=3, text=album))
+  tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='', data=cover))
+  tags.save(filename)
+
+
+def test_migrate_baseline_database_and_sync(tmpdir, library):
+  filename = os.path.join(library, 'Artist', 'Album', '01.mp3')
+  write_track(filename, 'Title', 'Artist', 'Album', b'\xff\xd8\xff\xe0cover')
+
+  # A database that was synchronized before the schema was versioned.
+  dbfile = str(tmpdir.join('database.sqlite'))
+  conn = sqlite3.connect(dbfile)
+  conn.execute(BASELINE_SCHEMA)
+  conn.execute('INSERT INTO track (mime, path, last_update_time, title, '
+    'artist, album, has_cover) VALUES (?, ?, ?, ?, ?, ?, 1)', ('audio/mp3',
+    'Artist/Album/01.mp3', int(time.time()) + 60, 'Title', 'Artist', 'Album'))
+  conn.commit()
+  conn.close()
+
+  database.init('sqlite:///' + dbfile)
+  with open(os.devnull, 'w') as devnull:
+    report = database.syncdb(progress=devnull)
+  assert report.counts['updated'] == 1
+  assert report.counts['new'] == 0
+
+  with database.Session() as session:
+    track = session.query(database.Track).one()
+    assert track.cover_hash is not None
+    assert track.size == os.path.getsize(filename)
+    assert track.mtime is not None
+    assert track.artist_id is not None
+    assert [x.name for x in session.query(database.Artist)] == ['Artist']
+    assert session.query(database.SchemaVersion.version).scalar() == database.SCHEMA_VERSION
+
+  # The data migrations only run once.
+  with open(os.devnull, 'w') as devnull:
+    report = database.syncdb(progress=devnull)
+  assert report.counts['updated'] == 0
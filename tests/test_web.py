@@ -0,0 +1,42 @@
+# Copyright (c) 2016  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from qu.web import create_app, views
+import pytest
+
+
+@pytest.mark.parametrize('key', [[1, 'a', None, 2.5], []])
+def test_decode_cursor(key):
+  assert views.decode_cursor(views.encode_cursor(key)) == key
+
+
+@pytest.mark.parametrize('key', [{'a': 1}, [{'a': 1}, 2, 3, 4, 5], [[1], 2]])
+def test_decode_cursor_invalid(key):
+  with pytest.raises(ValueError):
+    views.decode_cursor(views.encode_cursor(key))
+
+
+@pytest.mark.parametrize('url', ['/api/artists', '/api/albums'])
+def test_catalogue_invalid_cursor(library, url):
+  client = create_app().test_client()
+  assert client.get(url).status_code == 200
+  for key in [[[1], 2], [{'a': 1}, 2], [1]]:
+    response = client.get(url, query_string={'cursor': views.encode_cursor(key)})
+    assert response.status_code == 400